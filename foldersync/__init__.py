@@ -3,7 +3,21 @@
 import json
 import os
 import re
+import posixpath
+import stat
 import fnmatch
+import threading
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Number of files in a single archive when files are uploaded in bulk
+BULK_CHUNK = 1000
 
 def get_relative_path(root, path):
     """Returns the path of a file relative to the root."""
@@ -30,57 +44,216 @@ def unix_path_join(path1, path2):
     return path1 + path2
 
 
+def _list_directory(dirpath):
+  """Lists a directory, returns a list of (name, status, is_directory) tuples
+  using a single stat call per entry."""
+  entries = []
+  if scandir is not None:
+    for item in scandir(dirpath):
+      try:
+        status = item.stat()
+      except OSError:
+        continue
+      entries.append((item.name, status, stat.S_ISDIR(status.st_mode) and not item.is_symlink()))
+  else:
+    for name in os.listdir(dirpath):
+      filename = os.path.join(dirpath, name)
+      try:
+        status = os.lstat(filename)
+        if stat.S_ISLNK(status.st_mode):
+          # Symbolic links are followed, but never descended into
+          status = os.stat(filename)
+          entries.append((name, status, False))
+          continue
+      except OSError:
+        continue
+      entries.append((name, status, stat.S_ISDIR(status.st_mode)))
+  return entries
+
+def walk_tree(root, root_rel=''):
+  """Walks a directory tree top-down like os.walk(), but carries the relative
+  unix paths and the stat results of the entries along. Yields tuples of
+  (dirpath, dirpath_rel, directories, files) where directories and files are
+  lists of (name, status) tuples. Subdirectories removed from the directories
+  list are not visited."""
+  pending = [(root, root_rel)]
+  while pending:
+    dirpath, dirpath_rel = pending.pop()
+    try:
+      listing = _list_directory(dirpath)
+    except OSError:
+      continue
+    directories = [(name, status) for name, status, is_directory in listing if is_directory]
+    files = [(name, status) for name, status, is_directory in listing if not is_directory]
+    yield dirpath, dirpath_rel, directories, files
+    for name, _ in reversed(directories):
+      pending.append((os.path.join(dirpath, name), unix_path_join(dirpath_rel, name)))
+
 class Entry:
   """Keeps track of the modification time of a file and processing."""
-  def __init__(self, filename):
+  def __init__(self, filename, path=None, status=None):
     self.filename = filename
-    self.date_modified = os.stat(self.filename).st_mtime
-    self.size = os.stat(self.filename).st_size
+    self.path = path
+    if status is None:
+      status = os.stat(self.filename)
+    self.status = status
+    self.is_directory = stat.S_ISDIR(status.st_mode)
+    self.date_modified = status.st_mtime
+    self.size = status.st_size
     self.digest = None
+    self.signature = None
 
-    self.has_changed_locally()
+  def has_changed_locally(self, status=None):
 
-  def has_changed_locally(self):
+    if status is None:
+      status = os.stat(self.filename)
+    self.status = status
 
-    date_modified = os.stat(self.filename).st_mtime
-
-    if date_modified != self.date_modified:
-      self.date_modified = date_modified
+    if status.st_mtime != self.date_modified:
+      self.date_modified = status.st_mtime
+      self.size = status.st_size
       return True
     else:
       return False
 
 class FolderSync(object):
 
-  def __init__(self, storage, local_folder, remote_folder, force_update=False):
+  def __init__(self, storage, local_folder, remote_folder, force_update=False, manifest=None, digests=None, workers=1, inventory=False,
+      bulk_threshold=None):
     self._entries = {}
     self._ignore = []
     self._local_folder = local_folder
     self._remote_folder = remote_folder
-    self._storage = storage 
+    self._default_storage = storage
     self._force_update = force_update
+    self._lock = threading.RLock()
+    self._transfers = None
+    if workers > 1:
+      from foldersync.transfer import TransferPool
+      self._transfers = TransferPool([storage.clone() for i in range(workers)])
     self._first_scan = True
+    self._listing = None
+    self._use_inventory = inventory
+    self._inventory = None
+    self._bulk_threshold = bulk_threshold
+    self._pending = None
+    self._bulk = False
+    self._manifest = manifest
+    if self._manifest is not None:
+      self._manifest.load()
+    self._digests = digests
+    if self._digests is not None:
+      self._digests.load()
+
+  @property
+  def _storage(self):
+    """The storage of the current transfer worker or the default storage."""
+    if self._transfers is not None:
+      storage = self._transfers.storage()
+      if storage is not None:
+        return storage
+    return self._default_storage
+
+  def _transfer(self, entry):
+    """Uploads the entry and records it in the manifest. Files are handed over
+    to the transfer workers if there are any, directories are always created
+    immediately so that they exist before any of the files inside them is sent.
+    While the transfers are collected for a bulk upload files are only queued."""
+    if self._pending is not None and not entry.is_directory:
+      self._pending.append(entry)
+      if len(self._pending) >= (BULK_CHUNK if self._bulk else max(BULK_CHUNK, self._bulk_threshold)):
+        pending, self._pending = self._pending, []
+        self._bulk = True
+        self._transfer_archives(pending)
+    elif self._transfers is None or entry.is_directory:
+      self._transfer_entry(entry)
+    else:
+      self._transfers.submit(self._transfer_entry, entry)
+
+  def _transfer_entry(self, entry):
+    self._put_file(entry)
+    self._update_manifest(entry)
+
+  def _transfer_pending(self):
+    """Uploads the entries collected during the first scan. If there are at least
+    bulk_threshold of them they are sent in archives, one round trip for many
+    files, otherwise they are transferred one by one."""
+    pending, self._pending = self._pending, None
+    bulk, self._bulk = self._bulk, False
+    if not pending:
+      return
+    if not bulk and len(pending) < self._bulk_threshold:
+      for entry in pending:
+        self._transfer(entry)
+      return
+    self._transfer_archives(pending)
+
+  def _transfer_archives(self, pending):
+    """Sends the entries in archives of at most BULK_CHUNK files. Called as soon
+    as enough entries are collected, so the upload starts during the scan."""
+    for i in xrange(0, len(pending), BULK_CHUNK):
+      if self._transfers is None:
+        self._transfer_archive(pending[i:i+BULK_CHUNK])
+      else:
+        self._transfers.submit(self._transfer_archive, pending[i:i+BULK_CHUNK])
+
+  def _transfer_archive(self, entries):
+    with self._lock:
+      print '[%s] Copying %d files in an archive ...' % (self._local_folder, len(entries))
+    try:
+      packed = self._storage.put_archive(self._remote_folder, [(entry.filename, entry.path) for entry in entries])
+    except Exception, e:
+      with self._lock:
+        print '[%s] Bulk upload failed (%s), copying files one by one ...' % (self._local_folder, e)
+      for entry in entries:
+        self._transfer_entry(entry)
+      return
+    # Files that were removed before they were packed are not synchronized
+    packed = set(path for localpath, path in packed)
+    for entry in entries:
+      if entry.path in packed:
+        self._update_manifest(entry)
 
   def _put_file(self, entry):
-    filename_rel = get_relative_path(self._local_folder, entry.filename)
-    filename_rel = to_unix_path(filename_rel)
     remote_filename = self._get_remote_path(entry)
-    if os.path.isdir(entry.filename):
-        print '[%s] Creating "%s" ...' % (self._local_folder, filename_rel)
-    else:
-        print '[%s] Copying "%s" ...' % (self._local_folder, filename_rel)
+    with self._lock:
+      if entry.is_directory:
+          print '[%s] Creating "%s" ...' % (self._local_folder, entry.path)
+      else:
+          print '[%s] Copying "%s" ...' % (self._local_folder, entry.path)
     self._storage.put(entry.filename, remote_filename)
 
   def _get_remote_path(self, entry):
-    filename_rel = get_relative_path(self._local_folder, entry.filename)
-    filename_rel = to_unix_path(filename_rel)
-    return unix_path_join(self._remote_folder, filename_rel)
+    return unix_path_join(self._remote_folder, entry.path)
+
+  def _get_relative_path(self, filename_full):
+    return to_unix_path(get_relative_path(self._local_folder, filename_full))
+
+  def _stat_remote(self, remote_filename):
+    """Returns the status of a remote file. During the first scan the status is
+    taken from the inventory of the whole remote tree if it was fetched, or
+    the remote directories are listed with a single request each if the storage
+    supports it, instead of requesting the status of every file separately."""
+    if not self._first_scan:
+      return self._storage.stat(remote_filename)
+    if self._inventory is not None:
+      prefix = unix_path_join(self._remote_folder, '')
+      if remote_filename.startswith(prefix):
+        return self._inventory.get(remote_filename[len(prefix):], None)
+    if not hasattr(self._storage, 'list'):
+      return self._storage.stat(remote_filename)
+    remote_dir, name = posixpath.split(remote_filename)
+    if self._listing is None or self._listing[0] != remote_dir:
+      self._listing = (remote_dir, self._storage.list(remote_dir))
+    if self._listing[1] is None:
+      return None
+    return self._listing[1].get(name, None)
 
   def _check_remote_file(self, entry): 
     remote_filename = self._get_remote_path(entry)
-    status = self._storage.stat(remote_filename)
+    status = self._stat_remote(remote_filename)
 
-    if status and os.path.isdir(entry.filename):
+    if status and entry.is_directory:
       return True 
 
     if not status:
@@ -89,41 +262,217 @@ class FolderSync(object):
       return False
     return True 
 
-  def _scan_entry(self, filename_full):
+  def _check_manifest(self, entry):
+    """Returns True if the manifest says that the entry was already synchronized."""
+    if self._manifest is None:
+      return False
+    record = self._manifest.get(self._get_manifest_path(entry))
+    if record is None or not record.synced:
+      return False
+    if record.matches(entry):
+      entry.digest = record.digest
+      return True
+    if record.size == entry.size and record.digest is not None:
+      entry.digest = record.digest
+      return self._check_digest(entry)
+    return False
+
+  def _check_digest(self, entry):
+    """Updates the digest of the entry, returns True if the content is the same
+    as when the entry was last synchronized. Always False if digests are not used."""
+    if self._digests is None or entry.is_directory:
+      return False
+    previous = entry.digest
+    try:
+      entry.digest = self._digests.digest(entry.filename, entry.status)
+    except (IOError, OSError):
+      entry.digest = None
+      return False
+    return previous is not None and previous == entry.digest
+
+  def _may_need_digest(self, filename_full, status, filename_rel, create=False):
+    """Returns False if the file is known to be unchanged without reading its content."""
+    if filename_full in self._entries:
+      return self._entries[filename_full].date_modified != status.st_mtime
+    if not self._first_scan and not create:
+      return False
+    if self._manifest is not None and not self._force_update:
+      record = self._manifest.get(filename_rel)
+      if record is not None and record.synced:
+        return record.size != status.st_size or record.date_modified != status.st_mtime
+    return True
+
+  def _get_manifest_path(self, entry):
+    return entry.path
+
+  def _update_manifest(self, entry):
+    if self._manifest is not None:
+      with self._lock:
+        self._manifest.update(self._get_manifest_path(entry), entry)
 
-    filename_rel = get_relative_path(self._local_folder, filename_full)
+  def _scan_entry(self, filename_full, status=None, filename_rel=None, create=False):
+    """Checks a local file or directory and transfers it if needed. Unknown paths
+    are only added during the first scan or if create is True, e.g. for paths
+    reported by events."""
 
-    if filename_full in self._entries:      
-      if self._entries[filename_full].has_changed_locally():
-        self._put_file(self._entries[filename_full]) 
-    elif self._first_scan:
-      # New file, add it.
-      self._entries[filename_full] = Entry(filename_full)
-      if self._force_update or not self._check_remote_file(self._entries[filename_full]):
-        self._put_file(self._entries[filename_full]) 
+    if filename_rel is None:
+      filename_rel = self._get_relative_path(filename_full)
+
+    with self._lock:
+      entry = self._entries.get(filename_full, None)
+      if entry is not None:
+        if not entry.has_changed_locally(status):
+          return
+        created = False
+      elif self._first_scan or create:
+        # New file, add it.
+        entry = Entry(filename_full, filename_rel, status)
+        self._entries[filename_full] = entry
+        created = True
+      else:
+        return
+
+    if not created:
+      if self._check_digest(entry):
+        self._update_manifest(entry)
+      else:
+        self._transfer(entry)
+    elif self._force_update:
+      self._check_digest(entry)
+      self._transfer(entry)
+    elif self._check_manifest(entry):
+      self._update_manifest(entry)
+    elif not self._check_remote_file(entry):
+      self._check_digest(entry)
+      self._transfer(entry)
+    else:
+      if entry.digest is None:
+        self._check_digest(entry)
+      self._update_manifest(entry)
 
   def scan(self):
     """Scan a local folder, copy any changed/new files."""
-    for dirpath, dirnames, filenames in os.walk(self._local_folder):
-      for dirname in dirnames[:]:
-        self._scan_entry(os.path.join(dirpath, dirname))
-#        dirname_rel = get_relative_path(self._local_folder, dirname_full)
-#        if self._must_ignore(dirname_rel):
-#          dirnames.remove(dirname)
-#        else:
-#          if not dirname_full in self._folders:
-#            if self._force_update or not self._check_folder(dirname_full):
-#              self._put_file(dirname_full)
-#            self._folders[dirname_full] = True
-
-      for filename in filenames:
-        # Check all files in the local folder.
-        self._scan_entry(os.path.join(dirpath, filename))
-          
+    if self._first_scan and self._use_inventory and hasattr(self._storage, 'inventory'):
+      print '[%s] Fetching remote inventory ...' % self._local_folder
+      self._inventory = self._storage.inventory(self._remote_folder)
+
+    if self._first_scan and self._bulk_threshold and hasattr(self._storage, 'put_archive'):
+      self._pending = []
+
+    self._scan_tree(self._local_folder, '')
+
+    self._transfer_pending()
+
+    if self._transfers is not None:
+      self._transfers.join()
+
     if self._force_update:
       self._force_update = False
 
     if self._first_scan:
       self._first_scan = False
+      self._listing = None
+      self._inventory = None
+      if self._manifest is not None:
+        # Forget files that were removed since the last run
+        with self._lock:
+          self._manifest.retain(set(self._get_manifest_path(entry) for entry in self._entries.values()))
+
+    if self._manifest is not None:
+      self._manifest.flush()
+
+  def forget(self, path):
+    """Forgets the entry of the file, or the entries of the directory and of
+    everything in it, so that they are checked again when they are scanned."""
+    prefix = os.path.join(path, '')
+    with self._lock:
+      for filename in [filename for filename in self._entries if filename == path or filename.startswith(prefix)]:
+        del self._entries[filename]
+
+  def move(self, source, destination):
+    """Handles a local move of a file or a directory by renaming it remotely
+    instead of uploading it again, and moves the entry, or all the entries in
+    the directory, to the new location. Returns False if the source is not
+    known, in that case nothing is done."""
+    prefix = os.path.join(source, '')
+    with self._lock:
+      moved = [entry for filename, entry in self._entries.items() if filename == source or filename.startswith(prefix)]
+      if not moved or not hasattr(self._storage, 'rename'):
+        return False
+      remote_source = unix_path_join(self._remote_folder, self._get_relative_path(source))
+      for entry in moved:
+        del self._entries[entry.filename]
+        if self._manifest is not None:
+          self._manifest.remove(self._get_manifest_path(entry))
+        entry.filename = destination + entry.filename[len(source):]
+        entry.path = self._get_relative_path(entry.filename)
+        self._entries[entry.filename] = entry
+
+    remote_destination = unix_path_join(self._remote_folder, self._get_relative_path(destination))
+    with self._lock:
+      print '[%s] Moving "%s" to "%s" ...' % (self._local_folder, self._get_relative_path(source), self._get_relative_path(destination))
+    try:
+      self._storage.rename(remote_source, remote_destination)
+    except (IOError, OSError), e:
+      print '[%s] Unable to move "%s" remotely (%s), copying it again ...' % (self._local_folder, self._get_relative_path(source), e)
+      for entry in moved:
+        # Forget the state, also the digest, so that the entries are uploaded again
+        entry.date_modified = None
+        entry.digest = None
+      if os.path.isdir(destination):
+        self.rescan(destination)
+      else:
+        self._scan_entry(destination, create=True)
+      return True
+
+    for entry in moved:
+      self._update_manifest(entry)
+    return True
+
+  def _prune_directory(self, dirpath_rel):
+    """Returns True if every file in the directory and its subdirectories is
+    ignored, so that the directory does not have to be scanned."""
+    return False
+
+  def rescan(self, dirpath):
+    """Scans a single local directory and its subdirectories for changes,
+    including files that were created since the first scan. The directory
+    itself is checked first, so a new one is created before its content."""
+    if dirpath == self._local_folder:
+      self._scan_tree(dirpath, '', True)
+    else:
+      dirpath_rel = self._get_relative_path(dirpath)
+      self._scan_entry(dirpath, None, dirpath_rel, True)
+      self._scan_tree(dirpath, dirpath_rel, True)
+
+  def _scan_tree(self, root, root_rel, create=False):
+    for dirpath, dirpath_rel, directories, files in walk_tree(root, root_rel):
+      for name, status in directories:
+        self._scan_entry(os.path.join(dirpath, name), status, unix_path_join(dirpath_rel, name), create)
+
+      # Subtrees whose content is all ignored are not visited at all
+      directories[:] = [(name, status) for name, status in directories
+        if not self._prune_directory(unix_path_join(dirpath_rel, name))]
+
+      files = [(os.path.join(dirpath, name), status, unix_path_join(dirpath_rel, name)) for name, status in files]
+
+      if self._digests is not None:
+        self._digests.prefetch([(filename_full, status) for filename_full, status, filename_rel in files
+          if self._may_need_digest(filename_full, status, filename_rel, create)])
+
+      for filename_full, status, filename_rel in files:
+        # Check all files in the local folder.
+        self._scan_entry(filename_full, status, filename_rel, create)
+
+  def close(self):
+    """Waits for the pending transfers and writes any pending state to disk."""
+    if self._transfers is not None:
+      self._transfers.close()
+      self._transfers = None
+    if self._manifest is not None:
+      self._manifest.flush()
+    if self._digests is not None:
+      self._digests.save()
+      self._digests.close()
 
 
@@ -0,0 +1,184 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+"""
+Delta encoding of files in the manner of rsync. The receiver computes a weak
+(rolling Adler-32) and a strong (MD5) checksum for each block of its copy of the
+file, the sender finds these blocks in the new version of the file and sends
+only references to them together with the data that was not found.
+
+The delta is a stream of operations: 'C' followed by two big endian 32-bit
+integers (first block, number of blocks) copies blocks of the old file, 'D'
+followed by a 32-bit length and the data inserts literal data and 'E' ends the
+stream.
+"""
+
+import os
+import mmap
+import zlib
+import math
+import struct
+import hashlib
+
+MOD_ADLER = 65521
+
+# Maximal length of a single literal data operation
+MAX_LITERAL = 1024 * 1024
+
+# Computes the block signatures of a file, runs on the remote machine with
+# either Python 2 or 3. Arguments: filename, block size.
+SIGNATURE_SCRIPT = '''
+import sys, zlib, hashlib
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+size = int(sys.argv[2])
+with open(sys.argv[1], 'rb') as fp:
+  while True:
+    block = fp.read(size)
+    if not block:
+      break
+    out.write(('%d %s\\n' % (zlib.adler32(block) & 0xffffffff, hashlib.md5(block).hexdigest())).encode('ascii'))
+'''
+
+# Applies a delta read from the standard input to a file, runs on the remote
+# machine with either Python 2 or 3. Arguments: filename, block size.
+PATCH_SCRIPT = '''
+import sys, os, struct
+source = getattr(sys.stdin, 'buffer', sys.stdin)
+path, size = sys.argv[1], int(sys.argv[2])
+temp = path + '.delta'
+def read(length):
+  data = source.read(length)
+  if len(data) != length:
+    raise EOFError('Truncated delta')
+  return data
+with open(path, 'rb') as basis:
+  with open(temp, 'wb') as output:
+    while True:
+      operation = read(1)
+      if operation == b'C':
+        index, count = struct.unpack('>II', read(8))
+        basis.seek(index * size)
+        output.write(basis.read(count * size))
+      elif operation == b'D':
+        length, = struct.unpack('>I', read(4))
+        output.write(read(length))
+      elif operation == b'E':
+        break
+      else:
+        raise ValueError('Illegal delta operation')
+os.chmod(temp, os.stat(path).st_mode & 0xfff)
+os.rename(temp, path)
+'''
+
+class DeltaTooLarge(Exception):
+  """Raised when the literal data of a delta exceeds the given limit."""
+  pass
+
+def block_size(size):
+  """Returns the block size for a file of the given size, roughly its square root."""
+  return max(2048, min(128 * 1024, int(math.sqrt(size)) & ~7))
+
+def weak_checksum(data):
+  return zlib.adler32(data) & 0xffffffff
+
+def strong_checksum(data):
+  return hashlib.md5(data).hexdigest()
+
+def parse_signatures(lines):
+  """Parses the output of SIGNATURE_SCRIPT into a list of (weak, strong) tuples."""
+  signatures = []
+  for line in lines:
+    fields = line.split()
+    if len(fields) == 2:
+      signatures.append((int(fields[0]), fields[1]))
+  return signatures
+
+def compute_delta(filename, signatures, size, max_literal=None):
+  """A generator of delta operations that transform the file with the given block
+  signatures into the local file. Yields ('C', index, count) and ('D', data) tuples.
+
+  Blocks that did not move are matched at once, the rolling checksum is only
+  advanced byte by byte where the content differs. Raises DeltaTooLarge as soon
+  as there are more than max_literal bytes of literal data, so the slow search
+  is not finished for a file that is sent in full anyway."""
+  table = {}
+  for index, (weak, strong) in enumerate(signatures):
+    table.setdefault(weak, []).append((index, strong))
+
+  with open(filename, 'rb') as fp:
+    length = os.fstat(fp.fileno()).st_size
+    if length == 0:
+      return
+    view = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      position = 0
+      literal = 0
+      sent = 0
+      weak = None
+      copy = None
+      while position + size <= length:
+        if weak is None:
+          weak = weak_checksum(view[position:position + size])
+        match = None
+        if weak in table:
+          strong = strong_checksum(view[position:position + size])
+          for index, candidate in table[weak]:
+            if candidate == strong:
+              match = index
+              break
+        if match is not None:
+          if literal < position:
+            if copy is not None:
+              yield copy
+              copy = None
+            for start in xrange(literal, position, MAX_LITERAL):
+              yield ('D', view[start:min(position, start + MAX_LITERAL)])
+            sent += position - literal
+          if copy is not None and copy[1] + copy[2] == match:
+            copy = ('C', copy[1], copy[2] + 1)
+          else:
+            if copy is not None:
+              yield copy
+            copy = ('C', match, 1)
+          position += size
+          literal = position
+          weak = None
+          continue
+        if position + size < length:
+          removed = ord(view[position])
+          added = ord(view[position + size])
+          a = ((weak & 0xffff) - removed + added) % MOD_ADLER
+          b = ((weak >> 16) - size * removed + a - 1) % MOD_ADLER
+          weak = (b << 16) | a
+        position += 1
+        if max_literal is not None and sent + position - literal > max_literal:
+          raise DeltaTooLarge('More than %d bytes of literal data' % max_literal)
+        if position - literal >= MAX_LITERAL:
+          if copy is not None:
+            yield copy
+            copy = None
+          yield ('D', view[literal:position])
+          sent += position - literal
+          literal = position
+
+      if max_literal is not None and sent + length - literal > max_literal:
+        raise DeltaTooLarge('More than %d bytes of literal data' % max_literal)
+      if copy is not None:
+        yield copy
+      for start in xrange(literal, length, MAX_LITERAL):
+        yield ('D', view[start:min(length, start + MAX_LITERAL)])
+    finally:
+      view.close()
+
+def write_delta(filename, signatures, size, output, max_literal=None):
+  """Writes the encoded delta to the output file, returns the number of literal
+  bytes. Raises DeltaTooLarge if there are more than max_literal of them."""
+  literal = 0
+  for operation in compute_delta(filename, signatures, size, max_literal):
+    if operation[0] == 'C':
+      output.write(struct.pack('>cII', 'C', operation[1], operation[2]))
+    else:
+      output.write(struct.pack('>cI', 'D', len(operation[1])))
+      output.write(operation[1])
+      literal += len(operation[1])
+  output.write('E')
+  return literal
@@ -0,0 +1,125 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import mmap
+import json
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from foldersync.manifest import write_json
+
+# Files larger than this are hashed through a memory map instead of reads.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+BLOCK_SIZE = 1024 * 1024
+
+def file_digest(filename, algorithm='sha1'):
+  """Returns the hex digest of the file content."""
+  digest = hashlib.new(algorithm)
+  with open(filename, 'rb') as fp:
+    size = os.fstat(fp.fileno()).st_size
+    if size >= MMAP_THRESHOLD:
+      view = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        for offset in xrange(0, size, BLOCK_SIZE):
+          digest.update(view[offset:offset + BLOCK_SIZE])
+      finally:
+        view.close()
+    else:
+      while True:
+        block = fp.read(BLOCK_SIZE)
+        if not block:
+          break
+        digest.update(block)
+  return digest.hexdigest()
+
+def _cache_key(status):
+  return '%d:%d:%r' % (status.st_ino, status.st_size, status.st_mtime)
+
+class DigestCache(object):
+  """Content digests of files keyed by (inode, size, mtime), so that a file is
+  only read again when its metadata changes. Digests of many files can be
+  computed concurrently with prefetch()."""
+
+  def __init__(self, filename=None, algorithm='sha1', workers=4):
+    self._filename = filename
+    self._algorithm = algorithm
+    self._workers = workers
+    self._pool = None
+    self._digests = {}
+    self._used = set()
+    self._lock = threading.Lock()
+
+  def load(self):
+    if not self._filename or not os.path.exists(self._filename):
+      return False
+    try:
+      with open(self._filename, 'r') as fp:
+        data = json.load(fp)
+    except ValueError:
+      return False
+    if data.get('algorithm', None) != self._algorithm:
+      return False
+    self._digests = data.get('digests', {})
+    return True
+
+  def save(self):
+    """Writes the digests that were used since the cache was loaded."""
+    if not self._filename:
+      return
+    with self._lock:
+      digests = dict((key, self._digests[key]) for key in self._used if key in self._digests)
+    write_json(self._filename, {'algorithm' : self._algorithm, 'digests' : digests})
+
+  def digest(self, filename, status=None):
+    """Returns the digest of a file, reads the file only if it is not cached."""
+    if status is None:
+      status = os.stat(filename)
+    key = _cache_key(status)
+    with self._lock:
+      self._used.add(key)
+      if key in self._digests:
+        return self._digests[key]
+    value = file_digest(filename, self._algorithm)
+    with self._lock:
+      self._digests[key] = value
+    return value
+
+  def prefetch(self, files):
+    """Computes digests of the given files, a list of (filename, status) tuples,
+    in a thread pool."""
+    missing = []
+    for filename, status in files:
+      if status is None:
+        try:
+          status = os.stat(filename)
+        except OSError:
+          continue
+      key = _cache_key(status)
+      with self._lock:
+        if key in self._digests:
+          self._used.add(key)
+          continue
+      missing.append((filename, status))
+
+    if len(missing) < 2 or self._workers < 2:
+      for filename, status in missing:
+        self._safe_digest((filename, status))
+      return
+
+    if self._pool is None:
+      self._pool = ThreadPool(self._workers)
+    self._pool.map(self._safe_digest, missing)
+
+  def _safe_digest(self, item):
+    try:
+      self.digest(item[0], item[1])
+    except (IOError, OSError):
+      pass
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
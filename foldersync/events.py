@@ -0,0 +1,65 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import time
+import threading
+
+class EventCoalescer(object):
+  """Collects paths of file system events and releases every path only once,
+  after no new event has arrived for it during the quiet window, or after it
+  has been pending for max_latency seconds, so that busy files are still
+  synchronized from time to time.
+
+  At most max_pending paths are kept. When the limit is reached further events
+  are recorded as a rescan of the directory that contains the path, so that an
+  event burst can not grow the queue without bounds and no change is lost."""
+
+  def __init__(self, quiet=0.5, max_latency=5.0, max_pending=10000):
+    self._quiet = quiet
+    self._max_latency = max_latency
+    self._max_pending = max_pending
+    self._pending = {}
+    self._overflows = 0
+    self._lock = threading.Lock()
+
+  def add(self, path, now=None, rescan=False):
+    """Records an event for the path, safe to call from any thread."""
+    if now is None:
+      now = time.time()
+    with self._lock:
+      if not path in self._pending and len(self._pending) >= self._max_pending:
+        self._overflows += 1
+        path = os.path.dirname(path)
+        rescan = True
+      if path in self._pending:
+        self._pending[path][1] = now
+        self._pending[path][2] = self._pending[path][2] or rescan
+      else:
+        self._pending[path] = [now, now, rescan]
+
+  def pop_ready(self, now=None):
+    """Removes and returns the paths that are ready to be processed, in the
+    order of their first event, as a list of (path, rescan) tuples where rescan
+    is True if the entire directory has to be scanned."""
+    if now is None:
+      now = time.time()
+    ready = []
+    with self._lock:
+      for path, (first, last, rescan) in self._pending.items():
+        if now - last >= self._quiet or now - first >= self._max_latency:
+          ready.append((first, path, rescan))
+      for _, path, _ in ready:
+        del self._pending[path]
+    ready.sort()
+    return [(path, rescan) for _, path, rescan in ready]
+
+  def overflows(self):
+    """Returns and resets the number of events that overflowed the queue."""
+    with self._lock:
+      overflows = self._overflows
+      self._overflows = 0
+      return overflows
+
+  def __len__(self):
+    with self._lock:
+      return len(self._pending)
@@ -0,0 +1,199 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+"""
+Ignore rules read from .syncignore files with the semantics of .gitignore: a
+file applies to its directory and everything below it, rules of deeper files
+take precedence over the ones above, the last matching rule in a file wins and
+a rule starting with ! includes the paths again. A rule ending with / only
+matches directories, a rule with a / at the start or in the middle is relative
+to the directory of the file, other rules match a name at any depth. Nothing
+inside an ignored directory can be included again.
+"""
+
+import os
+import re
+import posixpath
+
+IGNORE_FILE = ".syncignore"
+
+# Python 2 regular expressions are limited to 100 groups
+MAX_GROUPS = 99
+
+def translate(pattern):
+  """Translates a glob into a regular expression, * and ? do not match a
+  slash and ** matches any number of directories."""
+  i, n = 0, len(pattern)
+  result = []
+  while i < n:
+    c = pattern[i]
+    if c == '*':
+      if pattern[i:i+2] == '**' and (i == 0 or pattern[i-1] == '/') and (i + 2 == n or pattern[i+2] == '/'):
+        if i + 2 == n:
+          # Trailing /** matches everything inside
+          result.append('.*')
+          i += 2
+        else:
+          # Leading **/ or /**/ in the middle matches zero or more directories
+          result.append('(?:.*/)?')
+          i += 3
+      else:
+        result.append('[^/]*')
+        i += 1
+    elif c == '?':
+      result.append('[^/]')
+      i += 1
+    elif c == '[':
+      j = i + 1
+      if j < n and pattern[j] in '!^':
+        j += 1
+      if j < n and pattern[j] == ']':
+        j += 1
+      while j < n and pattern[j] != ']':
+        j += 1
+      if j >= n:
+        result.append('\\[')
+        i += 1
+      else:
+        characters = pattern[i+1:j].replace('\\', '\\\\')
+        if characters[0] in '!^':
+          result.append('[^/' + characters[1:] + ']')
+        else:
+          result.append('(?!/)[' + characters + ']')
+        i = j + 1
+    elif c == '\\' and i + 1 < n:
+      result.append(re.escape(pattern[i+1]))
+      i += 2
+    else:
+      result.append(re.escape(c))
+      i += 1
+  return ''.join(result)
+
+def _combine(rules):
+  """Compiles the (expression, negated) rules into a list of (regex, negated
+  flags) tuples where every regex is an alternation of at most MAX_GROUPS rules
+  in reverse order, so that the first alternative that matches is the last
+  matching rule. The list is ordered from the last rules to the first ones."""
+  rules = list(reversed(rules))
+  combined = []
+  for start in xrange(0, len(rules), MAX_GROUPS):
+    chunk = rules[start:start+MAX_GROUPS]
+    regex = re.compile('^(?:' + '|'.join('(%s)' % expression for expression, _ in chunk) + ')\\Z', re.DOTALL)
+    combined.append((regex, [negated for _, negated in chunk]))
+  return combined
+
+class IgnoreRules(object):
+  """The rules of a single ignore file, compiled into one matcher for files
+  and one for directories."""
+
+  def __init__(self, lines):
+    files = []
+    directories = []
+    for line in lines:
+      line = line.rstrip('\r\n')
+      if not line or line.startswith('#'):
+        continue
+      stripped = line.rstrip(' ')
+      if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+      line = stripped
+      negated = line.startswith('!')
+      if negated or line.startswith('\\!') or line.startswith('\\#'):
+        line = line[1:]
+      directory_only = line.endswith('/')
+      line = line.rstrip('/')
+      if not line:
+        continue
+      if '/' in line:
+        expression = translate(line.lstrip('/'))
+      else:
+        expression = '(?:.*/)?' + translate(line)
+      directories.append((expression, negated))
+      if not directory_only:
+        files.append((expression, negated))
+    self._files = _combine(files)
+    self._directories = _combine(directories)
+
+  @staticmethod
+  def load(filename):
+    with open(filename, 'r') as fp:
+      return IgnoreRules(fp)
+
+  def match(self, path, is_directory=False):
+    """Returns True if the path, relative to the directory of the file, is
+    ignored, False if it is included again and None if no rule matches."""
+    for regex, negated in (self._directories if is_directory else self._files):
+      m = regex.match(path)
+      if m:
+        return not negated[m.lastindex - 1]
+    return None
+
+class IgnoreTree(object):
+  """Ignore rules of a directory tree, read from the ignore files in any of
+  its directories. The rules that apply to a directory and the decision for
+  every directory are remembered, so a file is checked against the rules of
+  each ignore file above it only once."""
+
+  def __init__(self, root, filename=IGNORE_FILE):
+    self._root = root
+    self._filename = filename
+    self._rules = {}
+    self._chains = {}
+    self._ignored = {}
+
+  def reload(self, directory=None):
+    """Forgets the rules of an ignore file in the directory (relative to the
+    root) or of all the files if no directory is given, so that they are read
+    again when they are needed."""
+    if directory is None:
+      self._rules = {}
+    else:
+      self._rules.pop(directory, None)
+    self._chains = {}
+    self._ignored = {}
+
+  def _load(self, directory):
+    if not directory in self._rules:
+      filename = os.path.join(self._root, directory, self._filename)
+      try:
+        self._rules[directory] = IgnoreRules.load(filename)
+      except IOError:
+        self._rules[directory] = None
+    return self._rules[directory]
+
+  def _chain(self, directory):
+    """Returns the (directory, rules) tuples of the ignore files that apply to
+    the content of the directory, the deepest first."""
+    chain = self._chains.get(directory, None)
+    if chain is None:
+      chain = [] if not directory else self._chain(posixpath.dirname(directory))
+      rules = self._load(directory)
+      if rules is not None:
+        chain = [(directory, rules)] + chain
+      self._chains[directory] = chain
+    return chain
+
+  def _match(self, path, is_directory):
+    for directory, rules in self._chain(posixpath.dirname(path)):
+      result = rules.match(path[len(directory) + 1:] if directory else path, is_directory)
+      if result is not None:
+        return result
+    return False
+
+  def is_directory_ignored(self, directory):
+    """Returns True if the directory, and therefore all of its content, is ignored."""
+    if not directory:
+      return False
+    ignored = self._ignored.get(directory, None)
+    if ignored is None:
+      ignored = self.is_directory_ignored(posixpath.dirname(directory)) or self._match(directory, True)
+      self._ignored[directory] = ignored
+    return ignored
+
+  def is_ignored(self, path, is_directory=False):
+    """Returns True if the path relative to the root is ignored, the ignore
+    files themselves are always ignored."""
+    if is_directory:
+      return self.is_directory_ignored(path)
+    if posixpath.basename(path) == self._filename:
+      return True
+    return self.is_directory_ignored(posixpath.dirname(path)) or self._match(path, False)
@@ -0,0 +1,149 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+MANIFEST_VERSION = 1
+
+# Minimal number of seconds between two consecutive writes of the manifest.
+SAVE_INTERVAL = 30
+
+def default_cache_dir():
+  """Returns the per-user directory where foldersync keeps its state."""
+  base = os.environ.get('XDG_CACHE_HOME', None)
+  if not base:
+    base = os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'foldersync')
+
+def manifest_filename(cache_dir, local_folder, destination, extension='manifest'):
+  """Returns the manifest (or other state) file for a given source and destination pair."""
+  key = hashlib.sha1(('%s\n%s' % (os.path.abspath(local_folder), destination)).encode('utf-8')).hexdigest()
+  return os.path.join(cache_dir, '%s.%s' % (key, extension))
+
+def write_json(filename, data):
+  """Atomically writes data to a JSON file by renaming a temporary file."""
+  folder = os.path.dirname(os.path.abspath(filename))
+  if not os.path.isdir(folder):
+    os.makedirs(folder)
+
+  handle, temp = tempfile.mkstemp(prefix='.%s-' % os.path.basename(filename), dir=folder)
+  try:
+    with os.fdopen(handle, 'w') as fp:
+      json.dump(data, fp, separators=(',', ':'))
+    if os.name == 'nt' and os.path.exists(filename):
+      os.unlink(filename)
+    os.rename(temp, filename)
+  except:
+    if os.path.exists(temp):
+      os.unlink(temp)
+    raise
+
+class Record(object):
+  """Last known state of a single file, as it was when it was synchronized. The
+  signature summarizes anything else the remote copy was produced from."""
+  def __init__(self, size=None, date_modified=None, digest=None, synced=False, signature=None):
+    self.size = size
+    self.date_modified = date_modified
+    self.digest = digest
+    self.synced = synced
+    self.signature = signature
+
+  def matches(self, entry):
+    """Returns True if the local metadata of the entry is the same as recorded."""
+    return self.size == entry.size and self.date_modified == entry.date_modified
+
+  def to_list(self):
+    return [self.size, self.date_modified, self.digest, self.synced, self.signature]
+
+  @staticmethod
+  def from_list(data):
+    return Record(*data[:5])
+
+class Manifest(object):
+  """Persistent table of synchronized files, keyed by their relative unix path.
+
+  The manifest is written atomically (to a temporary file that is then renamed)
+  after a batch of updates at most every SAVE_INTERVAL seconds and when flush()
+  is called, so an interrupted synchronization can be resumed from the last
+  written batch."""
+
+  def __init__(self, filename, source=None, destination=None):
+    self._filename = filename
+    self._source = source
+    self._destination = destination
+    self._records = {}
+    self._pending = 0
+    self._saved = time.time()
+
+  def load(self):
+    """Loads the manifest from disk, ignores missing or incompatible files."""
+    self._records = {}
+    self._pending = 0
+    if not os.path.exists(self._filename):
+      return False
+    try:
+      with open(self._filename, 'r') as fp:
+        data = json.load(fp)
+    except ValueError:
+      return False
+
+    if data.get('version', None) != MANIFEST_VERSION:
+      return False
+    if self._source is not None and data.get('source', None) != self._source:
+      return False
+    if self._destination is not None and data.get('destination', None) != self._destination:
+      return False
+
+    for path, record in data.get('files', {}).items():
+      self._records[path] = Record.from_list(record)
+    return True
+
+  def save(self):
+    """Atomically writes the manifest to disk."""
+    data = {'version' : MANIFEST_VERSION, 'source' : self._source, 'destination' : self._destination,
+      'files' : dict((path, record.to_list()) for path, record in self._records.items())}
+    write_json(self._filename, data)
+    self._pending = 0
+    self._saved = time.time()
+
+  def get(self, path):
+    return self._records.get(path, None)
+
+  def update(self, path, entry, synced=True):
+    """Records the current state of an entry and saves the manifest after each batch."""
+    record = Record(entry.size, entry.date_modified, entry.digest, synced, entry.signature)
+    if path in self._records and self._records[path].to_list() == record.to_list():
+      return
+    self._records[path] = record
+    self._touch()
+
+  def remove(self, path):
+    if path in self._records:
+      del self._records[path]
+      self._touch()
+
+  def retain(self, paths):
+    """Removes all the records that are not listed in paths."""
+    for path in list(self._records.keys()):
+      if not path in paths:
+        del self._records[path]
+        self._pending += 1
+
+  def flush(self):
+    """Writes any pending changes to disk."""
+    if self._pending > 0:
+      self.save()
+
+  def _touch(self):
+    self._pending += 1
+    if time.time() - self._saved >= SAVE_INTERVAL:
+      self.save()
+
+  def __contains__(self, path):
+    return path in self._records
+
+  def __len__(self):
+    return len(self._records)
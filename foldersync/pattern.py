@@ -31,11 +31,18 @@ The main entry points for this modules are:
 * :class:`Pattern`: An individual glob
 """
 
+import re
 from os import path, getcwd, walk
 from fnmatch import fnmatch, filter as fnfilter
 from itertools import chain
 from collections import defaultdict
 
+# Number of directories a Pattern or a PatternSet remembers the match for
+DIRECTORY_CACHE_SIZE = 4096
+
+# Compiled patterns ignore the case where the file system does
+CASE_FLAGS = re.IGNORECASE if path.normcase("A") != "A" else 0
+
 def get_path_components(directory):
     """Breaks a path to a directory into a (drive, list-of-folders) tuple
 
@@ -148,6 +155,11 @@ class Matcher(object):
         :exc:`PatternError`"""
         raise PatternError("Match should not be directly constructed")
 
+    def regex(self):
+        """Returns a regular expression that matches the same path elements
+        as :meth:`Matcher.match`"""
+        raise PatternError("Match should not be directly constructed")
+
     def __eq__(self, other):
         return (isinstance(other, type(self)) and
                 self.pattern == other.pattern)
@@ -182,6 +194,42 @@ class FNMatcher(Matcher):
         """Returns True if the pattern matches the string"""
         return fnmatch(string, self.pattern)
 
+    def regex(self):
+        """Translates the pattern like :func:`fnmatch.translate()`, except
+        that the wildcards never match a ``/``"""
+        pattern = self.pattern
+        i, n = 0, len(pattern)
+        result = []
+        while i < n:
+            c = pattern[i]
+            i += 1
+            if c == "*":
+                result.append("[^/]*")
+            elif c == "?":
+                result.append("[^/]")
+            elif c == "[":
+                j = i
+                if j < n and pattern[j] == "!":
+                    j += 1
+                if j < n and pattern[j] == "]":
+                    j += 1
+                while j < n and pattern[j] != "]":
+                    j += 1
+                if j >= n:
+                    result.append("\\[")
+                else:
+                    characters = pattern[i:j].replace("\\", "\\\\")
+                    i = j + 1
+                    if characters[0] == "!":
+                        result.append("[^/" + characters[1:] + "]")
+                    elif characters[0] == "^":
+                        result.append("(?!/)[\\" + characters + "]")
+                    else:
+                        result.append("(?!/)[" + characters + "]")
+            else:
+                result.append(re.escape(c))
+        return "".join(result)
+
 
 class ConstantMatcher(Matcher):
     """A :class:`Matcher` for matching the constant passed in the constructor.
@@ -195,6 +243,10 @@ class ConstantMatcher(Matcher):
         """Returns True if the argument matches the constant."""
         return self.pattern == path.normcase(string)
 
+    def regex(self):
+        """Returns the constant as a regular expression"""
+        return re.escape(self.pattern)
+
 
 class Section(object):
     """A minimal object that holds fragments of a :class:`Pattern` path.
@@ -311,6 +363,11 @@ class Section(object):
             if self.elements[0].match(element):
                 yield index + 1
 
+    def regex(self):
+        """Returns a regular expression matching the directories of the
+        :class:`Section`, each followed by a ``/``"""
+        return "".join(matcher.regex() + "/" for matcher in self.elements)
+
     def __eq__(self, other):
         return isinstance(other, Section) and self.str == other.str
 
@@ -447,6 +504,18 @@ class Pattern(object):
             # This is a 'constant' pattern - use comprehension
             self.file_filter = lambda files: [ file for file in files if path.normcase(file) == self.file_pattern ]
 
+        # The same for a single file name
+        if self.file_pattern == "*":
+            self.file_match = lambda file: True
+        elif "*" in self.file_pattern or "?" in self.file_pattern:
+            self.file_match = lambda file: fnmatch(file, self.file_pattern)
+        else:
+            self.file_match = lambda file: path.normcase(file) == self.file_pattern
+
+        # Match types of the directories matched so far, see match_directory
+        self._directories = {}
+        self._compiled = None
+
         if elements:
             self.bound_end = elements[-1] != "**"
         else:
@@ -478,7 +547,21 @@ class Pattern(object):
 
         If ``self.bound_end`` is True, the last :class:`Section` must match
         the last contiguous elements of *path_elements*.
+
+        The result is remembered for the directory, so all the files of a
+        directory are matched against the sections only once.
         """
+        key = tuple(path_elements)
+        result = self._directories.get(key)
+        if result is None:
+            if len(self._directories) >= DIRECTORY_CACHE_SIZE:
+                self._directories.clear()
+            result = self._match_directory(path_elements)
+            self._directories[key] = result
+        return result
+
+    def _match_directory(self, path_elements):
+        """Implementation of match_directory without the cache"""
 
         def match_recurse(is_start, sections, path_elements, location):
             """A private function for implementing the recursive search.
@@ -575,13 +658,74 @@ class Pattern(object):
         matched   |= this_match
         unmatched -= this_match
 
+    def matches_all_under(self, path_elements):
+        """Returns True if every file in the directory, expressed as a list of
+        path elements, and in all of its subdirectories matches the pattern."""
+        return self.all_files() and \
+            self.match_directory(path_elements) == MatchType.MATCH_ALL_SUBDIRECTORIES
+
+    def matches_none_under(self, path_elements):
+        """Returns True if no file in the directory, expressed as a list of
+        path elements, or in any of its subdirectories can match the pattern."""
+        return self.match_directory(path_elements) == MatchType.NO_MATCH_NO_SUBDIRECTORIES
+
     def match_file(self, elements):
         if self.match_directory(elements[:-1]) & MatchType.BIT_MATCH:
-            #print self.file_pattern + " - " + elements[-1]
-            return len(self.file_filter([elements[-1]])) > 0
+            return self.file_match(elements[-1])
         else:
             return False
 
+    def regex(self):
+        """Returns a regular expression that matches the same paths, relative
+        and separated by ``/``, as :meth:`Pattern.match_file`.
+
+        A ``**`` between the sections matches any number of directories and
+        a pattern that is not bound to the start or the end of the path may
+        be preceded or followed by any directories."""
+        anything = "(?:.*/)?"
+        if self.sections:
+            expression = anything.join(section.regex() for section in self.sections)
+            if not self.bound_start:
+                expression = anything + expression
+            if not self.bound_end:
+                expression = expression + anything
+        else:
+            expression = "" if self.bound_start else anything
+        return expression + Matcher.create(self.file_pattern).regex() + "\\Z"
+
+    def match_path(self, path):
+        """Returns True if the path, relative and separated by ``/``, matches
+        the pattern. Equivalent to :meth:`Pattern.match_file` for the elements
+        of the path, but done by a single compiled regular expression."""
+        if self._compiled is None:
+            self._compiled = re.compile(self.regex(), re.DOTALL | CASE_FLAGS)
+        return self._compiled.match(path) is not None
+
+    def extensions(self):
+        """Returns the set of extensions, the part of the file name from the
+        last ``.`` on, that the files matched by the pattern can have, or None
+        if the extension is not fixed by the pattern"""
+        name = self.file_pattern
+        dot = name.rfind(".")
+        suffix = name[dot:] if dot >= 0 else name
+        if any(c in suffix for c in "*?[]"):
+            return None
+        return set([suffix if dot >= 0 else ""])
+
+    def prefixes(self):
+        """Returns the set of names one of which the first directory of the
+        paths matched by the pattern must have, or None if the first directory
+        is not fixed by the pattern. None in the set stands for the files in
+        the root directory."""
+        if not self.bound_start:
+            return None
+        if not self.sections:
+            return set([None])
+        first = self.sections[0].elements[0]
+        if isinstance(first, ConstantMatcher):
+            return set([first.pattern])
+        return None
+
     def _to_string(self):
         """Implemented a function for __str__ and __repr__ to use, but
         which prevents infinite recursion when migrating to Python 3"""
@@ -612,6 +756,8 @@ class PatternSet(object):
     def __init__(self):
         self.patterns   = []
         self._all_files = False
+        self._directories = {}
+        self._compiled = None
 
     def _compute_all_files(self):
         """Handles lazy evaluation of self.all_files"""
@@ -632,6 +778,8 @@ class PatternSet(object):
         """Adds a :class:`Pattern` to the :class:`PatternSet`"""
         assert isinstance(pattern, Pattern)
         self.patterns.append(pattern)
+        self._directories = {}
+        self._compiled = None
         if self._all_files is not None:
             self._all_files = self._all_files or pattern.all_files()
 
@@ -654,12 +802,16 @@ class PatternSet(object):
         assert all(isinstance(pat, Pattern) for pat in patterns)
         self.patterns.extend(patterns)
         self._all_files = None
+        self._directories = {}
+        self._compiled = None
 
     def remove(self, pattern):
         """Remove a :class:`Pattern` from the :class:`PatternSet`"""
         assert isinstance(pattern, Pattern)
         self.patterns.remove(pattern)
         self._all_files = None
+        self._directories = {}
+        self._compiled = None
 
     def match_files(self, matched, unmatched):
         """Apply the include and exclude filters to those files in *unmatched*,
@@ -691,9 +843,75 @@ class PatternSet(object):
                     format(self.all_files(),
                            ", ".join(str(pat) for pat in self.patterns)))
 
+    def matches_all_under(self, path_elements):
+        """Returns True if every file in the directory and in all of its
+        subdirectories matches one of the patterns."""
+        return any(pattern.matches_all_under(path_elements) for pattern in self.patterns)
+
+    def matches_none_under(self, path_elements):
+        """Returns True if no file in the directory or in any of its
+        subdirectories can match any of the patterns."""
+        return all(pattern.matches_none_under(path_elements) for pattern in self.patterns)
+
+    def match_directory(self, path_elements):
+        """Returns the list of :class:`Pattern` instances that match the
+        directory, expressed as a list of path elements. The list is remembered
+        for the directory, so only the file patterns of these have to be tested
+        for the files in it."""
+        key = tuple(path_elements)
+        patterns = self._directories.get(key)
+        if patterns is None:
+            if len(self._directories) >= DIRECTORY_CACHE_SIZE:
+                self._directories.clear()
+            patterns = [pattern for pattern in self.patterns
+                        if pattern.match_directory(path_elements) & MatchType.BIT_MATCH]
+            self._directories[key] = patterns
+        return patterns
+
     def match_file(self, elements):
-       for pattern in self.iter():
-            if pattern.match_file(elements):
+        for pattern in self.match_directory(elements[:-1]):
+            if pattern.file_match(elements[-1]):
                 return True
-       return False
-
+        return False
+
+    def regex(self):
+        """Returns a regular expression that matches the paths matched by any
+        of the patterns, see :meth:`Pattern.regex()`"""
+        return "|".join("(?:%s)" % pattern.regex() for pattern in self.patterns)
+
+    def extensions(self):
+        """Returns the union of the extensions of the patterns or None, see
+        :meth:`Pattern.extensions()`"""
+        return _union(pattern.extensions() for pattern in self.patterns)
+
+    def prefixes(self):
+        """Returns the union of the prefixes of the patterns or None, see
+        :meth:`Pattern.prefixes()`"""
+        return _union(pattern.prefixes() for pattern in self.patterns)
+
+    def match_path(self, path):
+        """Returns True if any of the patterns matches the path"""
+        if not self.patterns:
+            return False
+        if self._compiled is None:
+            self._compiled = compile_patterns(self.patterns)
+        return self._compiled.match(path) is not None
+
+def _union(sets):
+    """Returns the union of the sets, None if any of them is None"""
+    result = set()
+    for item in sets:
+        if item is None:
+            return None
+        result |= item
+    return result
+
+def compile_patterns(includes, excludes=()):
+    """Compiles lists of :class:`Pattern` and :class:`PatternSet` instances
+    into a single regular expression that matches a relative path, separated
+    by ``/``, if no exclude matches it and either any include matches it or
+    there are no includes."""
+    expression = "|".join("(?:%s)" % pattern.regex() for pattern in includes)
+    if excludes:
+        expression = "(?!%s)(?:%s)" % ("|".join("(?:%s)" % pattern.regex() for pattern in excludes), expression)
+    return re.compile(expression, re.DOTALL | CASE_FLAGS)
@@ -49,11 +49,25 @@ class Content(object):
       os.close(fp)
     return self._path
 
+  def detach(self):
+    """Returns the filename and whether it is a temporary file, which is not
+    removed with the object anymore and has to be removed by the caller."""
+    filename = self.get_filename()
+    temporary, self._cleanup = self._cleanup, False
+    return filename, temporary
+
 class Processor(object):
 
+  # The data the processor was created from, see create_processor()
+  configuration = None
+
   def process(self, content, context):
     return content
 
+  def dependencies(self):
+    """Returns the files other than the processed one that the output depends on."""
+    return []
+
 def register_processor(name, definition):
   processors[name] = definition
 
@@ -66,10 +80,13 @@ def create_processor(data):
   name = data['processor']
 
   if name in processors:
-    return processors[name](data)
+    processor = processors[name](data)
+  else:
+    print "Warning: Processor '%s' not defined" % name
+    processor = Processor()
 
-  print "Warning: Processor '%s' not defined" % name
-  return Processor()
+  processor.configuration = data
+  return processor
 
 
 
@@ -0,0 +1,171 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from foldersync.manifest import write_json
+from foldersync.digest import DigestCache
+
+CACHE_VERSION = 1
+
+# Default limit of the total size of the cached outputs in bytes
+CACHE_SIZE = 512 * 1024 * 1024
+
+def processor_configuration(processor):
+  """Returns a JSON serializable description of the processor configuration."""
+  if processor.configuration is not None:
+    return processor.configuration
+  return processor.__class__.__name__
+
+class OutputCache(object):
+  """Outputs of processor stacks kept in a local directory. An output is stored
+  under a key computed from the content of the processed file, the
+  configuration of the processors, the content of the files they depend on,
+  such as templates, and the export context, so it is reused only if none of
+  them changed. If the outputs take more than max_size bytes the least
+  recently used ones are removed."""
+
+  def __init__(self, directory, max_size=CACHE_SIZE):
+    self._directory = directory
+    self._max_size = max_size
+    self._index = os.path.join(directory, 'index')
+    self._outputs = {}
+    self._size = 0
+    self._digests = DigestCache(os.path.join(directory, 'digests'))
+    self._lock = threading.Lock()
+
+  def load(self):
+    """Loads the index of the cached outputs, ignores missing or incompatible files."""
+    self._outputs = {}
+    self._size = 0
+    self._digests.load()
+    if not os.path.exists(self._index):
+      return False
+    try:
+      with open(self._index, 'r') as fp:
+        data = json.load(fp)
+    except ValueError:
+      return False
+    if data.get('version', None) != CACHE_VERSION:
+      return False
+    for key, output in data.get('outputs', {}).items():
+      if os.path.exists(self._path(key)):
+        self._outputs[key] = output
+        self._size += output[0]
+    return True
+
+  def save(self):
+    """Writes the index and the digests of the inputs to disk."""
+    with self._lock:
+      self._evict()
+      data = {'version' : CACHE_VERSION, 'outputs' : dict(self._outputs)}
+    write_json(self._index, data)
+    self._digests.save()
+
+  def key(self, filename, status, processors, context):
+    """Returns the key of the output of the processors for the file."""
+    key = hashlib.sha1('%d\n%s\n' % (CACHE_VERSION, self._digests.digest(filename, status)))
+    for processor in processors:
+      key.update(json.dumps(processor_configuration(processor), sort_keys=True) + '\n')
+      for dependency in processor.dependencies():
+        try:
+          key.update('%s %s\n' % (dependency, self._digests.digest(dependency)))
+        except (IOError, OSError):
+          key.update('%s -\n' % dependency)
+    key.update(json.dumps(context, sort_keys=True))
+    return key.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self._directory, 'outputs', key[:2], key)
+
+  def get(self, key):
+    """Returns the file with the cached output or None if there is none. The
+    file may be removed by the eviction of outputs, see checkout()."""
+    with self._lock:
+      return self._get(key)
+
+  def _get(self, key):
+    output = self._outputs.get(key, None)
+    if output is None:
+      return None
+    filename = self._path(key)
+    if not os.path.exists(filename):
+      self._size -= output[0]
+      del self._outputs[key]
+      return None
+    output[1] = time.time()
+    return filename
+
+  def checkout(self, key):
+    """Returns a temporary hard link to the cached output, or a copy of it if
+    links are not supported, or None if there is none. Unlike the file returned
+    by get() it is not removed when the output is evicted, the caller has to
+    remove it."""
+    with self._lock:
+      filename = self._get(key)
+      if filename is None:
+        return None
+      handle, temp = tempfile.mkstemp(prefix='.%s-' % key, dir=os.path.dirname(filename))
+      os.close(handle)
+      try:
+        try:
+          os.unlink(temp)
+          os.link(filename, temp)
+        except (AttributeError, OSError):
+          shutil.copyfile(filename, temp)
+      except:
+        if os.path.exists(temp):
+          os.unlink(temp)
+        raise
+      return temp
+
+  def put(self, key, filename):
+    """Stores a copy of the output file, returns the file in the cache."""
+    target = self._path(key)
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+      try:
+        os.makedirs(folder)
+      except OSError:
+        if not os.path.isdir(folder):
+          raise
+    handle, temp = tempfile.mkstemp(prefix='.%s-' % key, dir=folder)
+    try:
+      with os.fdopen(handle, 'wb') as fp, open(filename, 'rb') as source:
+        shutil.copyfileobj(source, fp)
+      if os.name == 'nt' and os.path.exists(target):
+        os.unlink(target)
+      os.rename(temp, target)
+    except:
+      if os.path.exists(temp):
+        os.unlink(temp)
+      raise
+    size = os.path.getsize(target)
+    with self._lock:
+      if key in self._outputs:
+        self._size -= self._outputs[key][0]
+      self._outputs[key] = [size, time.time()]
+      self._size += size
+      if self._size > self._max_size:
+        self._evict(key)
+    return target
+
+  def _evict(self, keep=None):
+    """Removes the least recently used outputs until the size limit is met."""
+    if self._size <= self._max_size:
+      return
+    for key in sorted(self._outputs, key=lambda key: self._outputs[key][1]):
+      if key == keep:
+        continue
+      self._size -= self._outputs.pop(key)[0]
+      try:
+        os.unlink(self._path(key))
+      except OSError:
+        pass
+      if self._size <= self._max_size:
+        return
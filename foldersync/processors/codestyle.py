@@ -44,7 +44,9 @@ class AStyleProcessor(Processor):
 
 class LicenseProcessor(Processor):
   def __init__(self, data):
+    self._source = None
     if 'source' in data:
+      self._source = os.path.abspath(data['source'])
       fp = open(data['source'], 'r')
       self._license = fp.read()
       fp.close()
@@ -72,6 +74,9 @@ class LicenseProcessor(Processor):
 
     return Content(content.get_source(), text=license + '\n' + text)
 
+  def dependencies(self):
+    return [self._source] if self._source else []
+
 
 
 register_processor('astyle', AStyleProcessor)
@@ -4,6 +4,7 @@ import os
 import copy
 
 from jinja2.exceptions import TemplateNotFound
+from jinja2 import meta
 import jinja2
 
 from foldersync.processors import register_processor, Processor, Content
@@ -21,6 +22,30 @@ class Jinja2Processor(Processor):
     self._context = {}
     if 'context' in data and type(data['context']) is dict:
       self._context.update(data['context'])
+    self._dependencies = []
+    self._find_dependencies(defaults['template'])
+
+  def _find_dependencies(self, name):
+    """Collects the files of the template and of the templates it extends,
+    includes or imports. If a referenced name is only known when rendering,
+    all the templates on the path are taken."""
+    try:
+      source, filename, _ = self._env.loader.get_source(self._env, name)
+    except TemplateNotFound:
+      return
+    filename = os.path.abspath(filename)
+    if filename in self._dependencies:
+      return
+    self._dependencies.append(filename)
+    for reference in meta.find_referenced_templates(self._env.parse(source)):
+      if reference is None:
+        for other in self._env.list_templates():
+          self._find_dependencies(other)
+      else:
+        self._find_dependencies(reference)
+
+  def dependencies(self):
+    return self._dependencies
 
   @staticmethod
   def _relative(root, path):
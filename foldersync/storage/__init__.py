@@ -2,11 +2,14 @@
 
 import os
 import re
+import posixpath
 import getpass
+import urlparse
 
 URI_REGEX = { 'ssh' : re.compile('ssh://(?P<auth>[^@]+)@(?P<hostname>[^/:]+)(:(?P<port>[0-9]+))?(?P<path>/.*)'),
   'ftp' : re.compile('ftp://(?P<auth>[^@]+)@(?P<hostname>[^/:]+)(?P<port>:[0-9]+)?(?P<path>/.*)'),
   'dummy' : re.compile('dummy://'),
+  'file' : re.compile('file://(?P<path>/.*)'),
   'local' : re.compile('(?P<path>/.*)')
 }
 
@@ -14,6 +17,40 @@ AUTH_REGEX = re.compile('(?P<username>[^:\\[]+)((:(?P<password>.*))|(\\[(?P<keyf
 #AUTH_REGEX = re.compile('(?P<username>[^:\\[]+)\\[(?P<keyfile>[^\\]]*)\\]')
 
 
+# Files of at least this size are uploaded under a temporary name, so that an
+# interrupted upload can be resumed, and renamed when they are complete
+RESUME_THRESHOLD = 16 * 1024 * 1024
+
+def partial_name(remotepath):
+  """Returns the temporary name of a remote file while it is being uploaded."""
+  directory, name = posixpath.split(remotepath)
+  return posixpath.join(directory, '.' + name + '.part')
+
+def put_resumable(localpath, remotepath, stat, write, verify, rename):
+  """Uploads a large file under its partial_name(), continuing where a previous
+  attempt was interrupted, verifies it and renames it into place. The steps are
+  given by the storage: stat(path) returns a Status or None, write(localpath,
+  path, offset) writes the file from the offset on, verify(localpath, path,
+  size) compares the uploaded file with the local one and rename(old, new)
+  replaces the target."""
+  size = os.path.getsize(localpath)
+  partial = partial_name(remotepath)
+  status = stat(partial)
+  offset = 0
+  # A part written before the local file was last modified is of another version
+  if status is not None and status.size <= size and status.date_modified >= os.path.getmtime(localpath):
+    offset = status.size
+
+  write(localpath, partial, offset)
+  if not verify(localpath, partial, size):
+    if offset == 0:
+      raise IOError('Uploaded file "%s" does not match the local file' % remotepath)
+    # The resumed part did not belong to this version of the file
+    write(localpath, partial, 0)
+    if not verify(localpath, partial, size):
+      raise IOError('Uploaded file "%s" does not match the local file' % remotepath)
+  rename(partial, remotepath)
+
 class DummyStorage:
   def __init__(self):
     pass
@@ -21,14 +58,27 @@ class DummyStorage:
   def put(self, filename_full, remote_filename):
     pass
 
+  def makedirs(self, remotepath):
+    pass
+
   def stat(self, remotepath):
     return None
 
+  def list(self, remotepath):
+    return {}
+
+  def rename(self, remotepath_old, remotepath_new):
+    pass
+
+  def clone(self):
+    return DummyStorage()
+
 class Status:
-  def __init__(self, date_modified=None, size=None, digest=None):
+  def __init__(self, date_modified=None, size=None, digest=None, is_directory=False):
     self.date_modified = date_modified
     self.size = size
     self.digest = digest
+    self.is_directory = is_directory
 
 def parse_auth(auth, interactive=True):
   m = AUTH_REGEX.match(auth)
@@ -47,8 +97,45 @@ def parse_auth(auth, interactive=True):
 
   return auth
 
+def strip_password(uri):
+  """Removes the password from the URI so that it can be stored or printed."""
+  return re.sub('^(?P<protocol>[a-z]+://[^:@/]+):[^@]*@', '\\g<protocol>@', uri)
+
+def split_options(uri):
+  """Splits the options given as a query (e.g. ssh://user@host/path?delta=1) from
+  a remote URI, returns the URI without the query and a dictionary of options."""
+  if not '://' in uri or not '?' in uri:
+    return uri, {}
+  uri, query = uri.split('?', 1)
+  return uri, dict(urlparse.parse_qsl(query))
+
+def is_enabled(options, name, default=False):
+  """Interprets a storage option as a boolean flag."""
+  if not name in options:
+    return default
+  return options[name].lower() in ('1', 'yes', 'true', 'on')
+
+def parse_size(value):
+  """Parses a size in bytes with an optional K, M or G suffix."""
+  value = value.strip().upper()
+  for suffix, multiplier in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+    if value.endswith(suffix):
+      return int(float(value[:-1]) * multiplier)
+  return int(value)
+
+def pool_options(options):
+  """Returns the connection pool arguments of a storage given in the options."""
+  arguments = {}
+  if 'pool' in options:
+    arguments['pool_size'] = int(options['pool'])
+  if 'idle' in options:
+    arguments['idle_timeout'] = float(options['idle'])
+  return arguments
+
 def create_storage(uri, interactive=True):
 
+  uri, options = split_options(uri)
+
   for protocol, regex in URI_REGEX.items():
     m = regex.match(uri)
     if not m:
@@ -57,17 +144,25 @@ def create_storage(uri, interactive=True):
     if protocol == 'local':
       from . import local
       return local.LocalStorage(), os.path.abspath(uri)
+    elif protocol == 'file':
+      from . import local
+      return local.LocalStorage(hardlink=is_enabled(options, 'hardlink')), os.path.abspath(m.group('path'))
     elif protocol == 'ftp':
       from . import ftp
       m = m.groupdict(None)
       auth = parse_auth(m['auth'])
-      return ftp.FTPStorage(host=m['hostname'], username=auth['username'], password=auth['password'], port=m['port']), m['path']
+      return ftp.FTPStorage(host=m['hostname'], username=auth['username'], password=auth['password'], port=m['port'],
+        **pool_options(options)), m['path']
     elif protocol == 'dummy':
       return DummyStorage(), '/'
     else:
       from . import ssh
       auth = parse_auth(m.group('auth'))
-      return ssh.SSHStorage(host=m.group('hostname'), username=auth['username'], password=auth['password'], private_key=auth['keyfile'], port=m.group('port')), m.group('path')
+      return ssh.SSHStorage(host=m.group('hostname'), username=auth['username'], password=auth['password'], private_key=auth['keyfile'], port=m.group('port'),
+        delta=is_enabled(options, 'delta'), compress=is_enabled(options, 'compress'),
+        window_size=parse_size(options['window']) if 'window' in options else None,
+        packet_size=parse_size(options['packet']) if 'packet' in options else None,
+        pipelined=is_enabled(options, 'pipelined', True), **pool_options(options)), m.group('path')
 
   raise Exception('Illegal authentication specification')
 
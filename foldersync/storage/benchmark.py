@@ -0,0 +1,289 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+"""
+Throughput self-test of the SSH storage. Starts a stand-in SSH server on the
+local machine behind a relay that delays the traffic to emulate a link with
+the given round trip time and uploads the same files with different transport
+settings, so that the best settings for a link can be picked.
+
+Usage: python -m foldersync.storage.benchmark [-r rtt_ms] [-s size_mb] [-n files] [-z] [options ...]
+
+Every options argument is a set of URI options as used in SSH destinations,
+e.g. "compress=1&window=8M". The default settings are always measured first.
+"""
+
+import os
+import sys
+import time
+import errno
+import getopt
+import socket
+import shutil
+import tempfile
+import threading
+import Queue
+
+import paramiko
+
+from foldersync.storage import create_storage
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+RELAY_BUFFER = 64 * 1024
+
+class _StubServer(paramiko.ServerInterface):
+
+  def check_auth_password(self, username, password):
+    if username == USERNAME and password == PASSWORD:
+      return paramiko.AUTH_SUCCESSFUL
+    return paramiko.AUTH_FAILED
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+  def check_channel_request(self, kind, chanid):
+    if kind == 'session':
+      return paramiko.OPEN_SUCCEEDED
+    return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+class _StubHandle(paramiko.SFTPHandle):
+
+  def stat(self):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+class _StubSFTP(paramiko.SFTPServerInterface):
+  """Serves the files of a local directory, just enough for the storage."""
+
+  root = None
+
+  def _path(self, path):
+    return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+  def open(self, path, flags, attr):
+    try:
+      fd = os.open(self._path(path), flags, 0644)
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    if flags & os.O_WRONLY:
+      mode = 'ab' if flags & os.O_APPEND else 'wb'
+    elif flags & os.O_RDWR:
+      mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+    else:
+      mode = 'rb'
+    handle = _StubHandle(flags)
+    handle.filename = path
+    handle.readfile = handle.writefile = os.fdopen(fd, mode)
+    return handle
+
+  def _call(self, function, *args):
+    try:
+      function(*args)
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def stat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  lstat = stat
+
+  def list_folder(self, path):
+    try:
+      directory = self._path(path)
+      return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(directory, name)), name)
+        for name in os.listdir(directory)]
+    except OSError, e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def remove(self, path):
+    return self._call(os.remove, self._path(path))
+
+  def rename(self, oldpath, newpath):
+    return self._call(os.rename, self._path(oldpath), self._path(newpath))
+
+  posix_rename = rename
+
+  def mkdir(self, path, attr):
+    return self._call(os.mkdir, self._path(path))
+
+  def rmdir(self, path):
+    return self._call(os.rmdir, self._path(path))
+
+class StubSSHServer(object):
+  """A minimal SFTP server that serves the given directory on a local port."""
+
+  def __init__(self, root):
+    self._key = paramiko.RSAKey.generate(2048)
+    self._root = root
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind(('127.0.0.1', 0))
+    self._socket.listen(5)
+    self.port = self._socket.getsockname()[1]
+    thread = threading.Thread(target=self._run)
+    thread.daemon = True
+    thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        client, _ = self._socket.accept()
+      except socket.error:
+        return
+      transport = paramiko.Transport(client)
+      transport.add_server_key(self._key)
+      handler = type('_RootedSFTP', (_StubSFTP, ), {'root' : self._root})
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, handler)
+      transport.start_server(server=_StubServer())
+
+  def close(self):
+    self._socket.close()
+
+class DelayRelay(object):
+  """Forwards the connections to a local port, delaying the data in both
+  directions by half of the round trip time."""
+
+  def __init__(self, port, rtt):
+    self._target = port
+    self._delay = rtt / 2.0
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind(('127.0.0.1', 0))
+    self._socket.listen(5)
+    self.port = self._socket.getsockname()[1]
+    thread = threading.Thread(target=self._run)
+    thread.daemon = True
+    thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        client, _ = self._socket.accept()
+      except socket.error:
+        return
+      server = socket.create_connection(('127.0.0.1', self._target))
+      for source, destination in ((client, server), (server, client)):
+        pending = Queue.Queue()
+        for target, args in ((self._receive, (source, pending)), (self._send, (destination, pending))):
+          thread = threading.Thread(target=target, args=args)
+          thread.daemon = True
+          thread.start()
+
+  def _receive(self, source, pending):
+    while True:
+      try:
+        data = source.recv(RELAY_BUFFER)
+      except socket.error:
+        data = ''
+      pending.put((time.time() + self._delay, data))
+      if not data:
+        return
+
+  def _send(self, destination, pending):
+    while True:
+      due, data = pending.get()
+      wait = due - time.time()
+      if wait > 0:
+        time.sleep(wait)
+      try:
+        if not data:
+          destination.shutdown(socket.SHUT_WR)
+          return
+        destination.sendall(data)
+      except socket.error, e:
+        if e.errno not in (errno.EPIPE, errno.ENOTCONN, errno.ECONNRESET):
+          raise
+        return
+
+  def close(self):
+    self._socket.close()
+
+def measure(port, options, files):
+  """Uploads the files with the given URI options, returns the elapsed time."""
+  uri = 'ssh://%s:%s@127.0.0.1:%d/upload' % (USERNAME, PASSWORD, port)
+  if options:
+    uri += '?' + options
+  storage, path = create_storage(uri, interactive=False)
+  try:
+    storage.put(files[0], path)
+    start = time.time()
+    for filename in files[1:]:
+      storage.put(filename, path + '/' + os.path.basename(filename))
+    return time.time() - start
+  finally:
+    storage.close()
+
+def usage():
+  print __doc__.strip()
+  print ''
+  print '  -r  Emulated round trip time in milliseconds (default: 80).'
+  print '  -s  Total size of the test files in megabytes (default: 32).'
+  print '  -n  Number of test files (default: 8).'
+  print '  -z  Use compressible test data instead of random data.'
+  exit()
+
+def main():
+
+  rtt = 80
+  size = 32
+  count = 8
+  compressible = False
+
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], 'r:s:n:zh')
+  except getopt.GetoptError:
+    usage()
+  for name, value in opts:
+    if name == '-r':
+      rtt = float(value)
+    elif name == '-s':
+      size = float(value)
+    elif name == '-n':
+      count = max(1, int(value))
+    elif name == '-z':
+      compressible = True
+    elif name == '-h':
+      usage()
+
+  workdir = tempfile.mkdtemp()
+  try:
+    source = os.path.join(workdir, 'source')
+    remote = os.path.join(workdir, 'remote')
+    os.mkdir(source)
+    os.mkdir(remote)
+    files = [os.path.join(source, 'upload')]
+    os.mkdir(files[0])
+    length = int(size * 1024 * 1024 / count)
+    for i in xrange(count):
+      filename = os.path.join(files[0], 'file%d' % i)
+      with open(filename, 'wb') as fp:
+        if compressible:
+          fp.write(('%08d some text that compresses well\n' % i) * (length / 40 + 1))
+        else:
+          fp.write(os.urandom(length))
+      files.append(filename)
+
+    server = StubSSHServer(remote)
+    relay = DelayRelay(server.port, rtt / 1000.0)
+
+    print 'Uploading %d files, %.1f MB in total, %.0f ms round trip time' % (count, size, rtt)
+    print ''
+    for options in [''] + args:
+      shutil.rmtree(os.path.join(remote, 'upload'), True)
+      elapsed = measure(relay.port, options, files)
+      print '%-40s %8.2f MB/s %8.2f s' % (options or '(defaults)', size / elapsed, elapsed)
+
+    relay.close()
+    server.close()
+  finally:
+    shutil.rmtree(workdir, True)
+
+if __name__ == "__main__":
+  main()
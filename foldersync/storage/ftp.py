@@ -2,14 +2,70 @@
 
 import sys
 import os
-from ftplib import FTP
+import re
+import time
+import calendar
+from ftplib import FTP, error_perm, error_reply, error_temp, all_errors
 
-from foldersync.storage import Status
+from foldersync.storage import Status, RESUME_THRESHOLD, put_resumable
+from foldersync.digest import file_digest
+from foldersync.storage.pool import ConnectionPool, POOL_SIZE, IDLE_TIMEOUT, is_network_error
 
-class FTPStorage(object):
-	def __init__(self, host, port=21, username=None, password=None):
+DIGEST_REGEX = re.compile('\\b(?P<digest>[0-9a-fA-F]{40})\\b')
+
+LIST_REGEX = re.compile('^(?P<mode>[-dlbcps][-rwxsStT]{9})[+@.]?\\s+\\d+\\s+\\S+\\s+\\S+\\s+(?P<size>\\d+)\\s+' +
+  '(?P<month>[A-Za-z]{3})\\s+(?P<day>\\d{1,2})\\s+(?P<time>\\d{1,2}:\\d{2}|\\d{4})\\s(?P<name>.+)$')
+
+# Seconds to wait for the server before the connection is considered broken
+TIMEOUT = 60
+
+def is_transient_error(error):
+  """Returns True if a failed connection attempt may succeed if repeated, a
+  rejected login is not repeated."""
+  return is_network_error(error) or isinstance(error, error_temp)
+
+class FTPConnection(object):
+  """A single logged in FTP control connection."""
+
+  def __init__(self, host, port, username, password):
     self.con = FTP()
-    self.con.connect(host, port)
+    self.con.connect(host, port, TIMEOUT)
+    try:
+      self.con.login(username, password)
+      self.con.voidcmd('TYPE I')
+    except:
+      self.con.close()
+      raise
+
+  def alive(self):
+    return self.con.sock is not None
+
+  def check(self):
+    """Makes a round trip to the server, returns False if the connection is broken."""
+    if self.con.sock is None:
+      return False
+    try:
+      self.con.voidcmd('NOOP')
+    except all_errors:
+      return False
+    return True
+
+  def close(self):
+    try:
+      self.con.quit()
+    except all_errors:
+      self.con.close()
+
+class FTPStorage(object):
+  """Stores files on a FTP server. The connections are kept in a pool that is
+  shared by all the threads that use the storage, broken connections are
+  replaced and the operations that failed because of them are repeated."""
+
+	def __init__(self, host, port=21, username=None, password=None, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+    if port is None:
+      port = 21
+    else:
+      port = int(str(port).lstrip(':'))
 
     if username is None:
 	    username = ''
@@ -17,28 +73,184 @@ class FTPStorage(object):
 	    password = ''
 
     self._time_offset = 0
+    self._mlsd = True
 
-    self.con.login(username, password)
+    self._pool = ConnectionPool(lambda: FTPConnection(host, port, username, password), pool_size, idle_timeout,
+      transient=is_transient_error)
+    # Connects immediately, so that a wrong configuration is reported at once
+    self._pool.release(self._pool.acquire())
 	
 	def put(self, localpath, remotepath = None):
+    self._pool.run(self._put, localpath, remotepath)
+
+  def _put(self, connection, localpath, remotepath):
     if os.path.isdir(localpath):
       try:
-        self.con.mkd(remotepath)
-      except:
+        connection.con.mkd(remotepath)
+      except error_perm:
         pass
+    elif os.path.getsize(localpath) < RESUME_THRESHOLD:
+      self._store(connection, localpath, remotepath)
     else:
-      f = open(localpath, 'rb')
-      self.con.storbinary('STOR %s' % remotepath, f)
+      self._put_resumable(connection, localpath, remotepath)
+
+  def _store(self, connection, localpath, remotepath, offset=0):
+    f = open(localpath, 'rb')
+    try:
+      if offset > 0:
+        f.seek(offset)
+        connection.con.storbinary('STOR %s' % remotepath, f, rest=offset)
+      else:
+        connection.con.storbinary('STOR %s' % remotepath, f)
+    finally:
       f.close()
 
+  def _put_resumable(self, connection, localpath, remotepath):
+    """Uploads a large file to a temporary name, continuing where a previous
+    attempt was interrupted using REST, verifies it and renames it into place."""
+    put_resumable(localpath, remotepath,
+      lambda path: self._stat(connection, path),
+      lambda localpath, path, offset: self._store(connection, localpath, path, offset),
+      lambda localpath, path, size: self._verify(connection, localpath, path, size),
+      lambda path_old, path_new: self._replace(connection, path_old, path_new))
+
+  def _replace(self, connection, remotepath_old, remotepath_new):
+    try:
+      connection.con.rename(remotepath_old, remotepath_new)
+    except error_perm:
+      # Some servers do not replace existing files
+      connection.con.delete(remotepath_new)
+      connection.con.rename(remotepath_old, remotepath_new)
+
+  def _verify(self, connection, localpath, remotepath, size):
+    """Compares the size and, if the server supports XSHA1, the digest of the
+    uploaded file with the local file."""
+    if connection.con.size(remotepath) != size:
+      return False
+    try:
+      m = DIGEST_REGEX.search(connection.con.sendcmd('XSHA1 %s' % remotepath))
+    except (error_perm, error_reply):
+      return True
+    if not m:
+      return True
+    return m.group('digest').lower() == file_digest(localpath, 'sha1')
+
+  def makedirs(self, remotepath):
+    """Creates a remote directory together with its missing parents. FTP has
+    no such command, so every directory on the path is created with MKD."""
+    self._pool.run(self._makedirs, remotepath)
+
+  def _makedirs(self, connection, remotepath):
+    path = '/' if remotepath.startswith('/') else ''
+    for name in remotepath.split('/'):
+      if not name:
+        continue
+      path = path + name
+      try:
+        connection.con.mkd(path)
+      except error_perm:
+        # Already exists
+        pass
+      path = path + '/'
+
 	def stat(self, remotepath):
+    return self._pool.run(self._stat, remotepath)
+
+  def _stat(self, connection, remotepath):
     try:
-      time = int(self.con.sendcmd('MDTM %s' % remotepath))
-      size = self.con.size(remotepath)
+      response = connection.con.sendcmd('MDTM %s' % remotepath)
+      size = connection.con.size(remotepath)
+    except error_perm:
+      # The file does not exist, any other error is passed on so that a broken
+      # connection is not mistaken for a missing file
+      return None
+    # The response is "213 YYYYMMDDHHMMSS" with optional fractions of a second, in UTC
+    date_modified = calendar.timegm(time.strptime(response[4:18], '%Y%m%d%H%M%S'))
+    return Status(date_modified + self._time_offset, size)
 
-      return Status(time + self._time_offset, size)
-    except:
+  def list(self, remotepath):
+    """Returns a dictionary of Status objects for the content of a remote
+    directory, uses MLSD if the server supports it and LIST otherwise. Returns
+    None if the directory does not exist."""
+    return self._pool.run(self._list, remotepath)
+
+  def _list(self, connection, remotepath):
+    lines = []
+    if self._mlsd:
+      try:
+        connection.con.retrlines('MLSD %s' % remotepath, lines.append)
+        return self._parse_mlsd(lines)
+      except error_perm, e:
+        if not str(e).startswith('50'):
+          return None
+        # Command not implemented, use LIST from now on
+        self._mlsd = False
+        lines = []
+    try:
+      connection.con.retrlines('LIST %s' % remotepath, lines.append)
+    except error_perm:
       return None
+    return self._parse_list(lines)
+
+  def _parse_mlsd(self, lines):
+    listing = {}
+    for line in lines:
+      if not ' ' in line:
+        continue
+      facts, name = line.split(' ', 1)
+      facts = dict(fact.split('=', 1) for fact in facts.split(';') if '=' in fact)
+      facts = dict((key.lower(), value) for key, value in facts.items())
+      kind = facts.get('type', '').lower()
+      if kind in ('cdir', 'pdir'):
+        continue
+      date_modified = None
+      if 'modify' in facts:
+        date_modified = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')) + self._time_offset
+      size = int(facts['size']) if 'size' in facts else None
+      listing[name] = Status(date_modified, size, is_directory=(kind == 'dir'))
+    return listing
+
+  def _parse_list(self, lines):
+    listing = {}
+    now = time.gmtime()
+    for line in lines:
+      m = LIST_REGEX.match(line)
+      if not m:
+        continue
+      name = m.group('name')
+      if m.group('mode')[0] == 'l' and ' -> ' in name:
+        name = name.split(' -> ', 1)[0]
+      if name in ('.', '..'):
+        continue
+      # LIST only has a resolution of minutes (or days for old files), so the
+      # end of the interval is used to avoid reporting files as outdated
+      if ':' in m.group('time'):
+        date = time.strptime('%d %s %s %s' % (now.tm_year, m.group('month'), m.group('day'), m.group('time')), '%Y %b %d %H:%M')
+        date_modified = calendar.timegm(date) + 59
+        if date_modified > calendar.timegm(now) + 86400:
+          date = time.strptime('%d %s %s %s' % (now.tm_year - 1, m.group('month'), m.group('day'), m.group('time')), '%Y %b %d %H:%M')
+          date_modified = calendar.timegm(date) + 59
+      else:
+        date = time.strptime('%s %s %s' % (m.group('time'), m.group('month'), m.group('day')), '%Y %b %d')
+        date_modified = calendar.timegm(date) + 86399
+      listing[name] = Status(date_modified + self._time_offset, int(m.group('size')), is_directory=(m.group('mode')[0] == 'd'))
+    return listing
+
+  def rename(self, remotepath_old, remotepath_new):
+    """Renames a remote file or directory using RNFR and RNTO."""
+    # Not repeated, the first attempt may have moved the file already
+    self._pool.run_once(self._rename, remotepath_old, remotepath_new)
+
+  def _rename(self, connection, remotepath_old, remotepath_new):
+    try:
+      connection.con.rename(remotepath_old, remotepath_new)
+    except error_perm, e:
+      raise IOError(str(e))
+
+  def clone(self):
+    """The storage can be used by several threads at once, the clones share
+    the pool of connections."""
+    return self
 
   def close(self):
-    self.con.quit()
+    self._pool.close()
@@ -3,13 +3,118 @@
 
 import sys
 import os
+import stat
+import math
+import errno
 import shutil
+import ctypes
+import ctypes.util
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 from foldersync.storage import Status
 
+# ioctl request that makes a file share the data of another one on copy on
+# write file systems (Btrfs, XFS), Linux only
+FICLONE = 0x40049409
+
+# Number of bytes copied by a single in-kernel copy call
+COPY_CHUNK = 64 * 1024 * 1024
+
+def _libc_function(name, restype, argtypes):
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    function = getattr(libc, name)
+  except (OSError, AttributeError, TypeError):
+    return None
+  function.restype = restype
+  function.argtypes = argtypes
+  return function
+
+_copy_file_range = None
+_sendfile = None
+if sys.platform.startswith('linux'):
+  _copy_file_range = _libc_function('copy_file_range', ctypes.c_ssize_t, [ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+  _sendfile = _libc_function('sendfile', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+
+# Errors that mean that a copy method is not supported for the given files
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+def _clone(source, destination):
+  if fcntl is None or not sys.platform.startswith('linux'):
+    return False
+  try:
+    fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+  except IOError, e:
+    if e.errno in _UNSUPPORTED:
+      return False
+    raise
+  return True
+
+def _copy_kernel(function, source, destination, size):
+  """Copies the file with copy_file_range or sendfile, the data never leaves
+  the kernel. Returns False if the call is not supported for these files."""
+  copied = 0
+  while copied < size:
+    if function is _copy_file_range:
+      result = function(source.fileno(), None, destination.fileno(), None, min(COPY_CHUNK, size - copied), 0)
+    else:
+      result = function(destination.fileno(), source.fileno(), None, min(COPY_CHUNK, size - copied))
+    if result < 0:
+      error = ctypes.get_errno()
+      if copied == 0 and error in _UNSUPPORTED:
+        return False
+      raise OSError(error, os.strerror(error))
+    if result == 0:
+      # The file was truncated in the meantime
+      break
+    copied += result
+  return True
+
+def copy_file(localpath, remotepath):
+  """Copies the content of a file using the fastest method available: a
+  reflink on copy on write file systems, an in-kernel copy with
+  copy_file_range or sendfile, or an ordinary copy through buffers. The
+  permissions and the modification time are preserved."""
+  if os.path.exists(remotepath) and os.path.samefile(localpath, remotepath):
+    # Opening the destination would truncate the source
+    raise IOError('"%s" and "%s" are the same file' % (localpath, remotepath))
+  with open(localpath, 'rb') as source:
+    with open(remotepath, 'wb') as destination:
+      size = os.fstat(source.fileno()).st_size
+      if not _clone(source, destination):
+        for function in (_copy_file_range, _sendfile):
+          if function is not None and _copy_kernel(function, source, destination, size):
+            break
+        else:
+          shutil.copyfileobj(source, destination, COPY_CHUNK)
+  copy_status(os.stat(localpath), remotepath)
+
+def copy_status(status, remotepath):
+  """Copies the permissions and the times to the file. The modification time is
+  rounded up to microseconds, the precision of utime, so that the copy never
+  appears older than the original."""
+  os.chmod(remotepath, stat.S_IMODE(status.st_mode))
+  os.utime(remotepath, (status.st_atime, math.ceil(status.st_mtime * 1e6) / 1e6 + 5e-7))
+
+def _replace(path_old, path_new):
+  """Renames a file, replaces an existing file also on Windows."""
+  if os.name == 'nt' and os.path.isfile(path_new):
+    os.unlink(path_new)
+  os.rename(path_old, path_new)
+
 class LocalStorage(object):
-  def __init__(self):
-    pass
+  """Copies files to a local folder. With hardlink enabled the files are linked
+  instead of copied where possible, so the destination shares the data with
+  the source."""
+
+  def __init__(self, hardlink=False):
+    self._hardlink = hardlink
 
   def put(self, localpath, remotepath):
     if not os.path.exists(localpath):
@@ -17,10 +122,48 @@ class LocalStorage(object):
     if os.path.isdir(localpath):
       try:
         os.mkdir(remotepath)
-      except IOError:
+      except OSError:
         pass
-    else:
-      shutil.copy(localpath, remotepath)
+    elif not (self._hardlink and self._link(localpath, remotepath)):
+      self._copy(localpath, remotepath)
+
+  def _copy(self, localpath, remotepath):
+    """Copies the file to a temporary file that then replaces the destination,
+    so a destination that is a hard link to the source, e.g. one linked by an
+    earlier synchronization with hardlink enabled, becomes a separate copy."""
+    temporary = remotepath + '.copy'
+    if os.path.lexists(temporary):
+      os.unlink(temporary)
+    try:
+      copy_file(localpath, temporary)
+    except:
+      if os.path.lexists(temporary):
+        os.unlink(temporary)
+      raise
+    _replace(temporary, remotepath)
+
+  def _link(self, localpath, remotepath):
+    """Replaces the file with a hard link to the local file, returns False if
+    the files are not on the same file system or links are not supported."""
+    temporary = remotepath + '.link'
+    try:
+      if os.path.exists(remotepath) and os.path.samefile(localpath, remotepath):
+        return True
+      if os.path.lexists(temporary):
+        os.unlink(temporary)
+      os.link(localpath, temporary)
+    except (OSError, AttributeError):
+      return False
+    _replace(temporary, remotepath)
+    return True
+
+  def makedirs(self, remotepath):
+    """Creates a directory together with its missing parents."""
+    try:
+      os.makedirs(remotepath)
+    except OSError, e:
+      if e.errno != errno.EEXIST or not os.path.isdir(remotepath):
+        raise
 
   def stat(self, remotepath):
     try:
@@ -29,3 +172,27 @@ class LocalStorage(object):
     except OSError:
       return None
 
+  def list(self, remotepath):
+    """Returns a dictionary of Status objects for the content of a directory,
+    None if the directory does not exist."""
+    try:
+      names = os.listdir(remotepath)
+    except OSError:
+      return None
+    listing = {}
+    for name in names:
+      try:
+        status = os.stat(os.path.join(remotepath, name))
+      except OSError:
+        continue
+      listing[name] = Status(status.st_mtime, status.st_size, is_directory=stat.S_ISDIR(status.st_mode))
+    return listing
+
+  def rename(self, remotepath_old, remotepath_new):
+    """Renames a file or a directory, replaces an existing file."""
+    _replace(remotepath_old, remotepath_new)
+
+  def clone(self):
+    """Returns a new instance of the storage with the same configuration."""
+    return LocalStorage(self._hardlink)
+
@@ -0,0 +1,164 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import sys
+import time
+import socket
+import threading
+
+# Number of connections a storage opens at most
+POOL_SIZE = 8
+# Seconds after which an unused connection is closed
+IDLE_TIMEOUT = 300
+# Connections that were not used for this many seconds are checked before use
+CHECK_INTERVAL = 10
+# Number of times a connection is established or an operation repeated
+RETRIES = 6
+# Delay before the first retry in seconds, doubled with every further attempt
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+def is_network_error(error):
+  """Returns True if the error of a connection attempt is caused by the network,
+  so that the attempt may succeed later, unlike for example a wrong password."""
+  return isinstance(error, (socket.error, EOFError))
+
+class ConnectionPool(object):
+  """Shares a limited number of connections between threads and replaces the
+  connections that break.
+
+  The connections are created by the connect function and have to provide
+  alive() (a cheap local test), check() (a round trip to the server) and
+  close(). An operation is run with run(function, *args) that calls the
+  function with a connection as the first argument. If the operation fails
+  and the connection does not pass the check anymore, the connection is
+  discarded and the operation is repeated on another one, waiting
+  exponentially longer between the attempts, unless it is run with
+  run_once(). Failures of operations on a working connection are passed on
+  to the caller. Opening a connection is only repeated if transient returns
+  True for the error, by default for network errors."""
+
+  def __init__(self, connect, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+      transient=is_network_error):
+    self._connect = connect
+    self._transient = transient
+    self._size = max(1, size)
+    self._idle_timeout = idle_timeout
+    self._retries = retries
+    self._backoff = backoff
+    self._idle = []
+    self._count = 0
+    self._condition = threading.Condition()
+
+  def _delay(self, attempt):
+    return min(MAX_BACKOFF, self._backoff * (2 ** attempt))
+
+  def _open(self):
+    attempt = 0
+    while True:
+      try:
+        return self._connect()
+      except Exception, e:
+        # Authentication and configuration errors are reported at once
+        if attempt >= self._retries or not self._transient(e):
+          raise
+        delay = self._delay(attempt)
+        sys.stderr.write('Unable to connect (%s), retrying in %.0f seconds ...\n' % (e, delay))
+        time.sleep(delay)
+        attempt += 1
+
+  def acquire(self):
+    """Returns a working connection, opens a new one if there is no idle
+    connection and the limit is not reached, otherwise waits for one."""
+    connection = None
+    with self._condition:
+      while True:
+        now = time.time()
+        for item in [item for item in self._idle if now - item[1] >= self._idle_timeout]:
+          self._idle.remove(item)
+          self._discard(item[0])
+        if self._idle:
+          connection, released = self._idle.pop()
+          break
+        if self._count < self._size:
+          self._count += 1
+          break
+        self._condition.wait()
+
+    if connection is None:
+      try:
+        return self._open()
+      except:
+        with self._condition:
+          self._count -= 1
+          self._condition.notify()
+        raise
+
+    try:
+      if now - released < CHECK_INTERVAL:
+        healthy = connection.alive()
+      else:
+        healthy = connection.check()
+    except Exception:
+      healthy = False
+    if healthy:
+      return connection
+    self.release(connection, True)
+    return self.acquire()
+
+  def release(self, connection, broken=False):
+    """Returns the connection to the pool, closes it if it is broken."""
+    with self._condition:
+      if broken:
+        self._discard(connection)
+      else:
+        self._idle.append((connection, time.time()))
+      self._condition.notify()
+
+  def _discard(self, connection):
+    self._count -= 1
+    try:
+      connection.close()
+    except Exception:
+      pass
+
+  def run(self, function, *args):
+    """Calls the function with a connection and the arguments, repeats the call
+    on a new connection if the connection breaks."""
+    return self._run(function, args, self._retries)
+
+  def run_once(self, function, *args):
+    """Calls the function like run() but never repeats it, for operations that
+    can not be safely repeated if the first call may have been carried out,
+    such as renaming. A broken connection is still discarded."""
+    return self._run(function, args, 0)
+
+  def _run(self, function, args, retries):
+    attempt = 0
+    while True:
+      connection = self.acquire()
+      try:
+        result = function(connection, *args)
+      except Exception:
+        error = sys.exc_info()
+        alive = False
+        try:
+          alive = connection.check()
+        except Exception:
+          pass
+        self.release(connection, not alive)
+        if alive or attempt >= retries:
+          raise error[0], error[1], error[2]
+        delay = self._delay(attempt)
+        sys.stderr.write('Connection lost (%s), retrying in %.0f seconds ...\n' % (error[1], delay))
+        time.sleep(delay)
+        attempt += 1
+        continue
+      self.release(connection)
+      return result
+
+  def close(self):
+    """Closes the idle connections, the pool can still be used afterwards."""
+    with self._condition:
+      while self._idle:
+        connection, _ = self._idle.pop()
+        self._discard(connection)
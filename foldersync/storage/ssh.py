@@ -8,16 +8,109 @@ Modified by James Yoneda to include command-line arguments.
 
 import getopt
 import os
+import stat
 import time
+import math
+import pipes
+import tarfile
 import paramiko
 import sys
+import socket
 import tempfile
 
-from foldersync.storage import Status
+from foldersync.storage import Status, RESUME_THRESHOLD, put_resumable
+from foldersync.digest import file_digest
+from foldersync.storage.pool import ConnectionPool, POOL_SIZE, IDLE_TIMEOUT, is_network_error
+from foldersync import delta
+
+INVENTORY_BUFFER = 256 * 1024
+# Seconds to wait for the listing before the errors are read
+INVENTORY_POLL = 0.5
+
+# Files smaller than this are always uploaded in full
+DELTA_MIN_SIZE = 1024 * 1024
+# A delta is only sent if its literal data is smaller than this part of the file
+DELTA_MAX_RATIO = 0.7
+DELTA_BUFFER = 256 * 1024
+
+ARCHIVE_BUFFER = 256 * 1024
+
+# Size of a single SFTP write request, larger requests are split by paramiko
+SFTP_BLOCK = 32 * 1024
+
+# Seconds between keepalive messages on idle connections
+KEEPALIVE = 30
+
+def is_transient_error(error):
+  """Returns True if a failed connection attempt may succeed if repeated."""
+  if isinstance(error, paramiko.AuthenticationException):
+    return False
+  return is_network_error(error) or isinstance(error, paramiko.SSHException)
+
+class SSHConnection(object):
+  """A single SSH transport with an SFTP session."""
+
+  def __init__(self, host, port, username, private_key, password, compress=False, window_size=None, packet_size=None):
+
+    # Begin the SSH transport.
+    transport_options = {}
+    if window_size:
+      transport_options['default_window_size'] = window_size
+    if packet_size:
+      transport_options['default_max_packet_size'] = packet_size
+    self.transport = paramiko.Transport((host, port), **transport_options)
+    self.transport.use_compression(compress)
+    # Authenticate the transport.
+    
+    try:
+      if password:
+        # Using Password.
+        self.transport.connect(username = username, password = password)
+      else:
+        ## Use Private Key.
+        #if not private_key:
+        #  # Try to use default key.
+        #  if os.path.exists(os.path.expanduser('~/.con/id_rsa')):
+        #    private_key = '~/.con/id_rsa'
+        #  elif os.path.exists(os.path.expanduser('~/.con/id_dsa')):
+        #    private_key = '~/.con/id_dsa'
+        #  else:
+        #    raise TypeError, "You have not specified a password or key."
+
+        private_key_file = os.path.expanduser(private_key)
+        rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file)
+        self.transport.connect(username = username, pkey = rsa_key)
+
+      self.transport.set_keepalive(KEEPALIVE)
+      self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+    except:
+      self.transport.close()
+      raise
+
+  def alive(self):
+    return self.transport.is_active()
+
+  def check(self):
+    """Makes a round trip to the server, returns False if the connection is broken."""
+    if not self.transport.is_active():
+      return False
+    try:
+      self.sftp.normalize('.')
+    except (IOError, EOFError, paramiko.SSHException):
+      return False
+    return True
+
+  def close(self):
+    self.sftp.close()
+    self.transport.close()
 
 class SSHStorage(object):
   """Connects and logs into the specified hostname. 
-  Arguments that are not given are guessed from the environment.""" 
+  Arguments that are not given are guessed from the environment.
+
+  The connections are kept in a pool that is shared by all the threads that
+  use the storage, broken connections are replaced and the operations that
+  failed because of them are repeated.""" 
 
   def __init__(self,
          host,
@@ -25,6 +118,13 @@ class SSHStorage(object):
          private_key = None,
          password = None,
          port = 22,
+         delta = False,
+         compress = False,
+         window_size = None,
+         packet_size = None,
+         pipelined = True,
+         pool_size = POOL_SIZE,
+         idle_timeout = IDLE_TIMEOUT,
          ):
 
     if port == None:
@@ -32,52 +132,32 @@ class SSHStorage(object):
     else:
       port = int(port);
 
-    self._sftp_live = False
-    self._sftp = None
     if not username:
       username = os.environ['LOGNAME']
 
+    self._delta = delta
+    self._pipelined = pipelined
+
     # Log to a temporary file.
     templog = tempfile.mkstemp('.txt', 'con-')[1]
     paramiko.util.log_to_file(templog)
 
-    # Begin the SSH transport.
-    self._transport = paramiko.Transport((host, port))
-    self._tranport_live = True
-    # Authenticate the transport.
-    
-    if password:
-      # Using Password.
-      self._transport.connect(username = username, password = password)
-    else:
-      ## Use Private Key.
-      #if not private_key:
-      #  # Try to use default key.
-      #  if os.path.exists(os.path.expanduser('~/.con/id_rsa')):
-      #    private_key = '~/.con/id_rsa'
-      #  elif os.path.exists(os.path.expanduser('~/.con/id_dsa')):
-      #    private_key = '~/.con/id_dsa'
-      #  else:
-      #    raise TypeError, "You have not specified a password or key."
-
-      private_key_file = os.path.expanduser(private_key)
-      rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file)
-      self._transport.connect(username = username, pkey = rsa_key)
-
-    self._sftp_connect()
+    self._pool = ConnectionPool(lambda: SSHConnection(host, port, username, private_key, password,
+      compress, window_size, packet_size), pool_size, idle_timeout, transient=is_transient_error)
+
     self._time_offset = 0
+    # Connects immediately, so that a wrong configuration is reported at once
+    self._time_offset = self._pool.run(self._clock_offset)
 
+  def _clock_offset(self, connection):
+    """Returns the difference between the local and the remote clock."""
     try:
-      remote_time = int(self._execute("date +%s")[0].strip())
-      self._time_offset = time.time() - remote_time
-    except:
-      pass
-
-  def _sftp_connect(self):
-    """Establish a SFTP connection."""
-    if not self._sftp_live:
-      self._sftp = paramiko.SFTPClient.from_transport(self._transport)
-      self._sftp_live = True
+      remote_time = int(self._execute(connection, "date +%s")[0].strip())
+      return time.time() - remote_time
+    except Exception:
+      if not connection.alive():
+        raise
+      return 0
 
   def put(self, localpath, remotepath = None):
     """Copies a file between the local host and the remote host."""
@@ -85,27 +165,272 @@ class SSHStorage(object):
       remotepath = os.path.split(localpath)[1]
     if not os.path.exists(localpath):
       return
-    self._sftp_connect()
+    self._pool.run(self._put, localpath, remotepath)
+
+  def _put(self, connection, localpath, remotepath):
     if os.path.isdir(localpath):
       try:
-        self._sftp.mkdir(remotepath)
+        connection.sftp.mkdir(remotepath)
       except IOError:
-        pass
+        if not connection.alive():
+          raise
     else:
-      self._sftp.put(localpath, remotepath)
+      if self._delta and self._put_delta(connection, localpath, remotepath):
+        return
+      self._upload(connection, localpath, remotepath)
+
+  def _upload(self, connection, localpath, remotepath):
+    """Uploads a file. Large files are written to a temporary name first,
+    continuing where a previous attempt was interrupted, verified and then
+    renamed into place."""
+    if os.path.getsize(localpath) < RESUME_THRESHOLD:
+      self._write(connection, localpath, remotepath)
+      return
+    put_resumable(localpath, remotepath,
+      lambda path: self._stat(connection, path),
+      lambda localpath, path, offset: self._write(connection, localpath, path, offset),
+      lambda localpath, path, size: self._verify(connection, localpath, path, size),
+      lambda path_old, path_new: self._rename(connection, path_old, path_new))
+
+  def _verify(self, connection, localpath, remotepath, size):
+    """Compares the size and, if sha1sum is available remotely, the digest of
+    the uploaded file with the local file."""
+    if connection.sftp.stat(remotepath).st_size != size:
+      return False
+    try:
+      output = self._execute(connection, 'sha1sum %s' % pipes.quote(remotepath))
+    except paramiko.SSHException:
+      if not connection.alive():
+        raise
+      return True
+    fields = output[0].split() if output else []
+    if not fields or len(fields[0]) != 40:
+      return True
+    return fields[0].lower() == file_digest(localpath, 'sha1')
+
+  def _write(self, connection, localpath, remotepath, offset=0):
+    """Writes the file in blocks, starting at the given offset. With pipelining
+    the blocks are sent without waiting for the server to acknowledge each one,
+    the acknowledgements are collected when the file is closed."""
+    with open(localpath, 'rb') as local:
+      if offset > 0:
+        local.seek(offset)
+        remote = connection.sftp.file(remotepath, 'r+b')
+        remote.seek(offset)
+      else:
+        remote = connection.sftp.file(remotepath, 'wb')
+      try:
+        remote.set_pipelined(self._pipelined)
+        while True:
+          data = local.read(SFTP_BLOCK)
+          if not data:
+            break
+          remote.write(data)
+      finally:
+        remote.close()
+
+  def _put_delta(self, connection, localpath, remotepath):
+    """Updates a remote file by sending only the blocks that changed. Returns
+    False if the file has to be uploaded in full instead."""
+    size = os.path.getsize(localpath)
+    if size < DELTA_MIN_SIZE:
+      return False
+    try:
+      remote_size = connection.sftp.stat(remotepath).st_size
+    except IOError:
+      if not connection.alive():
+        raise
+      return False
+    if remote_size < DELTA_MIN_SIZE:
+      return False
+
+    block_size = delta.block_size(remote_size)
+    status, output = self._run_script(connection, delta.SIGNATURE_SCRIPT, [remotepath, str(block_size)])
+    if status != 0:
+      return False
+    signatures = delta.parse_signatures(output.splitlines())
+
+    patch = tempfile.TemporaryFile()
+    try:
+      try:
+        delta.write_delta(localpath, signatures, block_size, patch, int(size * DELTA_MAX_RATIO))
+      except delta.DeltaTooLarge:
+        return False
+      patch.seek(0)
+      status, _ = self._run_script(connection, delta.PATCH_SCRIPT, [remotepath, str(block_size)], patch)
+      return status == 0
+    finally:
+      patch.close()
+
+  def _run_script(self, connection, script, arguments, source=None):
+    """Runs a Python script on the remote machine, optionally streaming the
+    content of a file to its input. Returns the exit status and the output."""
+    command = 'PYTHON=$(command -v python3 || command -v python) && "$PYTHON" -c %s %s' % \
+      (pipes.quote(script), ' '.join(pipes.quote(argument) for argument in arguments))
+    channel = connection.transport.open_session()
+    channel.exec_command(command)
+    if source is not None:
+      while True:
+        data = source.read(DELTA_BUFFER)
+        if not data:
+          break
+        channel.sendall(data)
+    channel.shutdown_write()
+    output = channel.makefile('rb', -1).read()
+    return channel.recv_exit_status(), output
+
+  def put_archive(self, remotepath, files):
+    """Uploads many files at once as a tar stream that is unpacked by tar on the
+    remote machine, so that there is no round trip per file. Files is a list of
+    (localpath, relative path) tuples. Modification times are preserved, converted
+    to the remote clock and rounded up to whole seconds so that the remote copies
+    never look older than the local files. Files that no longer exist are skipped, returns the list of the files
+    that were packed. Raises IOError if the archive could not be unpacked."""
+    return self._pool.run(self._put_archive, remotepath, files)
+
+  def _put_archive(self, connection, remotepath, files):
+    channel = connection.transport.open_session()
+    channel.exec_command('mkdir -p %s && tar -x --no-same-owner -f - -C %s' % (pipes.quote(remotepath), pipes.quote(remotepath)))
+    stream = channel.makefile('wb', ARCHIVE_BUFFER)
+    archive = tarfile.open(fileobj=stream, mode='w|', dereference=True)
+    packed = []
+    for localpath, path in files:
+      try:
+        info = archive.gettarinfo(localpath, path)
+        fp = open(localpath, 'rb') if info.isreg() else None
+      except (IOError, OSError):
+        # The file was removed in the meantime
+        continue
+      # Remote times are shifted by the clock offset when they are read, see _stat()
+      info.mtime = int(math.ceil(info.mtime - self._time_offset))
+      info.uname = info.gname = ''
+      try:
+        archive.addfile(info, fp)
+      finally:
+        if fp is not None:
+          fp.close()
+      packed.append((localpath, path))
+    archive.close()
+    stream.flush()
+    channel.shutdown_write()
+    error = channel.makefile_stderr('rb', -1).read()
+    if channel.recv_exit_status() != 0:
+      raise IOError('Unable to unpack archive: %s' % error.strip())
+    return packed
+
+  def makedirs(self, remotepath):
+    """Creates a remote directory together with its missing parents using a
+    single mkdir -p command."""
+    self._pool.run(self._makedirs, remotepath)
+
+  def _makedirs(self, connection, remotepath):
+    channel = connection.transport.open_session()
+    channel.exec_command('mkdir -p %s' % pipes.quote(remotepath))
+    error = channel.makefile_stderr('rb', -1).read()
+    if channel.recv_exit_status() != 0:
+      raise IOError('Unable to create directory "%s": %s' % (remotepath, error.strip()))
 
   def stat(self, remotepath):
     """Provides information about the remote file."""
-    self._sftp_connect()
+    return self._pool.run(self._stat, remotepath)
+
+  def _stat(self, connection, remotepath):
     try:
-      status = self._sftp.stat(remotepath)
+      status = connection.sftp.stat(remotepath)
       return Status(status.st_mtime + self._time_offset, status.st_size)
     except IOError:
+      if not connection.alive():
+        raise
       return None
 
-  def _execute(self, command):
+  def list(self, remotepath):
+    """Returns a dictionary of Status objects for the content of a remote
+    directory using a single request, None if the directory does not exist."""
+    return self._pool.run(self._list, remotepath)
+
+  def _list(self, connection, remotepath):
+    try:
+      attributes = connection.sftp.listdir_attr(remotepath)
+    except IOError:
+      if not connection.alive():
+        raise
+      return None
+    listing = {}
+    for status in attributes:
+      listing[status.filename] = Status(status.st_mtime + self._time_offset, status.st_size,
+        is_directory=stat.S_ISDIR(status.st_mode or 0))
+    return listing
+
+  def inventory(self, remotepath):
+    """Returns a dictionary of Status objects for the entire remote tree, keyed
+    by paths relative to remotepath. The tree is listed with a single remote
+    find command whose output is parsed as it arrives. Returns None if the
+    command is not available or fails, e.g. if the folder does not exist or
+    a directory in it can not be read, as the listing would be incomplete."""
+    return self._pool.run(self._inventory, remotepath)
+
+  def _inventory(self, connection, remotepath):
+    channel = connection.transport.open_session()
+    channel.exec_command("find %s -mindepth 1 -printf '%%y %%s %%T@ %%P\\0'" % pipes.quote(remotepath))
+    channel.settimeout(INVENTORY_POLL)
+    inventory = {}
+    errors = []
+    pending = ''
+    while True:
+      # Errors are read as they arrive, unread ones would stall the listing
+      # once they fill the window of the channel
+      while channel.recv_stderr_ready():
+        errors.append(channel.recv_stderr(INVENTORY_BUFFER))
+      try:
+        data = channel.recv(INVENTORY_BUFFER)
+      except socket.timeout:
+        continue
+      if not data:
+        break
+      records = (pending + data).split('\0')
+      pending = records.pop()
+      for record in records:
+        fields = record.split(' ', 3)
+        if len(fields) < 4:
+          continue
+        kind, size, date_modified, path = fields
+        inventory[path] = Status(float(date_modified) + self._time_offset, int(size), is_directory=(kind == 'd'))
+    channel.settimeout(None)
+    errors.append(channel.makefile_stderr('rb', -1).read())
+    if channel.recv_exit_status() != 0:
+      sys.stderr.write('Unable to list "%s": %s\n' % (remotepath, ''.join(errors).strip()))
+      return None
+    return inventory
+
+  def rename(self, remotepath_old, remotepath_new):
+    """Renames a remote file or directory, replaces an existing file."""
+    # Not repeated, the first attempt may have moved the file already
+    self._pool.run_once(self._rename, remotepath_old, remotepath_new)
+
+  def _rename(self, connection, remotepath_old, remotepath_new):
+    try:
+      connection.sftp.posix_rename(remotepath_old, remotepath_new)
+    except (IOError, AttributeError), e:
+      # Only a server (or a paramiko version) without the posix-rename extension
+      # is worked around, any other failure must not touch the target
+      if isinstance(e, IOError) and not (e.errno is None and 'unsupported' in str(e).lower()):
+        raise
+      # Plain rename fails if the target exists
+      try:
+        connection.sftp.remove(remotepath_new)
+      except IOError:
+        if not connection.alive():
+          raise
+      connection.sftp.rename(remotepath_old, remotepath_new)
+
+  def clone(self):
+    """The storage can be used by several threads at once, the clones share
+    the pool of connections."""
+    return self
+
+  def _execute(self, connection, command):
     """Execute a given command on a remote machine."""
-    channel = self._transport.open_session()
+    channel = connection.transport.open_session()
     channel.exec_command(command)
     output = channel.makefile('rb', -1).readlines()
     if output:
@@ -117,21 +442,30 @@ class SSHStorage(object):
     """Copies a file between the remote host and the local host."""
     if not localpath:
       localpath = os.path.split(remotepath)[1]
-    self._sftp_connect()
-    self._sftp.get(remotepath, localpath)
+    self._pool.run(self._download, remotepath, localpath)
+
+  def _download(self, connection, remotepath, localpath):
+    if self._pipelined:
+      remote = connection.sftp.file(remotepath, 'rb')
+      try:
+        remote.prefetch()
+        with open(localpath, 'wb') as local:
+          while True:
+            data = remote.read(SFTP_BLOCK)
+            if not data:
+              break
+            local.write(data)
+      finally:
+        remote.close()
+    else:
+      connection.sftp.get(remotepath, localpath)
 
   def close(self):
-    """Closes the connection and cleans up."""
-    # Close SFTP Connection.
-    if self._sftp_live:
-      self._sftp.close()
-      self._sftp_live = False
-    # Close the SSH Transport.
-    if self._tranport_live:
-      self._transport.close()
-      self._tranport_live = False
+    """Closes the idle connections and cleans up."""
+    self._pool.close()
 
   def __del__(self):
     """Attempt to clean up if not explicitly closed."""
-    self.close()
+    if hasattr(self, '_pool'):
+      self.close()
 
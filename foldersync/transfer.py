@@ -0,0 +1,113 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import sys
+import time
+import threading
+import traceback
+import Queue
+
+class TransferPool(object):
+  """A pool of worker threads that run transfer jobs from a bounded queue.
+
+  Each worker has its own storage, available to the job through storage()
+  while it is running, workers of a pool that does not transfer anything get
+  None. The storages are usually clones of one storage; a storage that can be
+  used by several threads at once, such as SSH or FTP with their pools of
+  connections, clones to itself, so the workers share it and the number of
+  connections is limited by its pool rather than by the number of workers.
+
+  Submitting blocks when the queue is full, so the producer can not run
+  arbitrarily ahead of the transfers. Pools can be chained into a pipeline by
+  submitting jobs that submit to the next pool, metrics() then shows which of
+  them holds the others back."""
+
+  def __init__(self, storages, queue_size=None, name='Transfer'):
+    if queue_size is None:
+      queue_size = 4 * len(storages)
+    self.name = name
+    self._queue = Queue.Queue(queue_size)
+    self._local = threading.local()
+    self._storages = storages
+    self._size = len(storages)
+    self._threads = []
+    self.failed = 0
+    self._metrics_lock = threading.Lock()
+    self._started = time.time()
+    self._jobs = 0
+    self._depth = 0
+    self._max_depth = 0
+    self._blocked = 0.0
+    self._busy = 0.0
+    for storage in storages:
+      thread = threading.Thread(target=self._run, args=(storage, ))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def __len__(self):
+    return len(self._threads)
+
+  def storage(self):
+    """Returns the storage of the current worker or None if called outside a worker."""
+    return getattr(self._local, 'storage', None)
+
+  def submit(self, function, *args):
+    """Queues a job, blocks if the queue is full."""
+    depth = self._queue.qsize()
+    start = time.time()
+    self._queue.put((function, args))
+    blocked = time.time() - start
+    with self._metrics_lock:
+      self._jobs += 1
+      self._depth += depth
+      self._max_depth = max(self._max_depth, depth)
+      self._blocked += blocked
+
+  def metrics(self):
+    """Returns a summary of the load: the number of jobs, the average and the
+    maximal depth of the queue seen by new jobs, the time the producers were
+    blocked by a full queue and how busy the workers were. A stage with a
+    mostly full queue and busy workers is the bottleneck of a pipeline."""
+    elapsed = max(time.time() - self._started, 1e-6)
+    with self._metrics_lock:
+      average = self._depth / float(self._jobs) if self._jobs else 0.0
+      return '%s: %d jobs, queue depth %.1f on average, %d at most of %d, blocked for %.1f s, workers busy %.0f%%' % \
+        (self.name, self._jobs, average, self._max_depth, self._queue.maxsize, self._blocked,
+        100.0 * self._busy / (elapsed * self._size))
+
+  def join(self):
+    """Waits until all the queued jobs are done."""
+    self._queue.join()
+
+  def close(self):
+    """Stops the workers after the queued jobs are done and closes their
+    storages, a storage shared by several workers only once."""
+    for thread in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+    closed = set()
+    for storage in self._storages:
+      if id(storage) not in closed and hasattr(storage, 'close'):
+        closed.add(id(storage))
+        storage.close()
+    self._storages = []
+
+  def _run(self, storage):
+    self._local.storage = storage
+    while True:
+      job = self._queue.get()
+      start = time.time()
+      try:
+        if job is None:
+          return
+        function, args = job
+        function(*args)
+      except Exception:
+        self.failed += 1
+        sys.stderr.write('%s failed: %s' % (self.name, traceback.format_exc()))
+      finally:
+        with self._metrics_lock:
+          self._busy += time.time() - start
+        self._queue.task_done()
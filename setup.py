@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 
+import sys
+
 from setuptools import setup
-from pkg_resources import WorkingSet , DistributionNotFound
+from pkg_resources import WorkingSet , DistributionNotFound, VersionConflict
 working_set = WorkingSet()
 
 requirements = ["watchdog>=0.8.0", 'jinja2>=2.8', 'markdown>=2.6.0']
 
+# Directories are listed with os.scandir, a backport is needed before Python 3.5
+if sys.version_info < (3, 5):
+    requirements.append('scandir>=1.5')
+
+# Transport window and packet size settings need paramiko 1.15
 try:
-    working_set.require('paramiko>=1.10.0')
-except DistributionNotFound:
-    reqirements.append('paramiko>=1.10.0')
+    working_set.require('paramiko>=1.15.0')
+except (DistributionNotFound, VersionConflict):
+    requirements.append('paramiko>=1.15.0')
 
 setup(name='FolderSync',
 	version='0.1.0',
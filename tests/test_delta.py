@@ -0,0 +1,57 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from foldersync import delta
+
+class DeltaTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.basis = os.path.join(self.root, 'basis')
+    self.changed = os.path.join(self.root, 'changed')
+    generator = random.Random(42)
+    data = ''.join(chr(generator.randint(0, 255)) for _ in xrange(200000))
+    with open(self.basis, 'wb') as fp:
+      fp.write(data)
+    with open(self.changed, 'wb') as fp:
+      fp.write(data[:50000] + 'inserted' + data[50000:150000] + data[160000:])
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def run_script(self, script, arguments, data=None):
+    process = subprocess.Popen([sys.executable, '-c', script] + arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = process.communicate(data)
+    self.assertEqual(process.returncode, 0)
+    return output
+
+  def signatures(self, size):
+    return delta.parse_signatures(self.run_script(delta.SIGNATURE_SCRIPT, [self.basis, str(size)]).splitlines())
+
+  def test_patch(self):
+    size = delta.block_size(os.path.getsize(self.basis))
+    patch = tempfile.TemporaryFile()
+    literal = delta.write_delta(self.changed, self.signatures(size), size, patch)
+    self.assertTrue(literal < 4 * size)
+    patch.seek(0)
+    self.run_script(delta.PATCH_SCRIPT, [self.basis, str(size)], patch.read())
+    with open(self.basis, 'rb') as basis, open(self.changed, 'rb') as changed:
+      self.assertEqual(basis.read(), changed.read())
+
+  def test_too_large(self):
+    size = delta.block_size(os.path.getsize(self.basis))
+    signatures = self.signatures(size)
+    self.assertRaises(delta.DeltaTooLarge, list, delta.compute_delta(self.changed, signatures, size, 100))
+    literal = delta.write_delta(self.changed, signatures, size, tempfile.TemporaryFile(), 4 * size)
+    self.assertRaises(delta.DeltaTooLarge, delta.write_delta, self.changed, signatures, size,
+      tempfile.TemporaryFile(), literal - 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import imp
+import random
+import shutil
+import tempfile
+import unittest
+
+from foldersync.storage.local import LocalStorage
+from foldersync.processors.cache import OutputCache
+
+folderexport = imp.load_source('folderexport', os.path.join(os.path.dirname(__file__), '..', 'bin', 'folderexport'))
+
+RULES = [
+  {'includes' : '**/*.txt', 'process' : {'processor' : 'regex', 'pattern' : 'secret', 'replacement' : 'public'}},
+  {'includes' : '**/*.raw', 'rename' : '%(name)s.bin'},
+]
+
+GLOB_ELEMENTS = ['**', '*', 'a', 'doc', '*.txt', 'x.txt', '*.md', 'a.*', '*.tar.gz', '?.txt', 'README', '*txt']
+PATH_NAMES = ['a', 'b', 'doc', 'x.txt', 'y.md', 'a.txt', 'f.tar.gz', 'README', 'txt', '.txt', 'X.TXT']
+
+def random_globs(generator):
+  globs = []
+  for _ in range(generator.randint(1, 2)):
+    glob = '/'.join(generator.choice(GLOB_ELEMENTS) for _ in range(generator.randint(1, 3)))
+    globs.append(('/' + glob) if generator.random() < 0.4 else glob)
+  return globs
+
+class PlainStorage(LocalStorage):
+  """A storage that creates remote folders one by one."""
+
+  makedirs = property()
+
+class RuleIndexTest(unittest.TestCase):
+  """Compares the rules found by the index with a scan of all the rules."""
+
+  def test_find(self):
+    generator = random.Random(4321)
+    for _ in range(200):
+      rules = []
+      for _ in range(generator.randint(1, 8)):
+        data = {'includes' : random_globs(generator)}
+        if generator.random() < 0.3:
+          data['excludes'] = random_globs(generator)
+        rules.append(folderexport.Rule(data))
+      index = folderexport.RuleIndex(rules)
+      for _ in range(50):
+        path = '/'.join(generator.choice(PATH_NAMES) for _ in range(generator.randint(1, 4)))
+        expected = None
+        for position, rule in enumerate(rules):
+          if rule.matches(path):
+            expected = position
+            break
+        self.assertEqual(index.find(path), expected, path)
+
+class ExportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.source = os.path.join(self.root, 'source')
+    self.destination = os.path.join(self.root, 'destination')
+    os.makedirs(os.path.join(self.source, 'a', 'b'))
+    os.mkdir(self.destination)
+    for i in range(10):
+      with open(os.path.join(self.source, 'a', 'b', 'f%d.txt' % i), 'w') as fp:
+        fp.write('a secret %d\n' % i)
+    with open(os.path.join(self.source, 'a', 'data.raw'), 'w') as fp:
+      fp.write('raw')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def export(self, rules=RULES, storage=None, **kwargs):
+    exporter = folderexport.FolderExporter(storage or LocalStorage(), self.source, self.destination, True, **kwargs)
+    for data in rules:
+      exporter.add_rule(folderexport.Rule(data))
+    exporter.scan()
+    failures = exporter.failures()
+    exporter.close()
+    return failures
+
+  def check_outputs(self):
+    for i in range(10):
+      with open(os.path.join(self.destination, 'a', 'b', 'f%d.txt' % i)) as fp:
+        self.assertEqual(fp.read(), 'a public %d\n' % i)
+    with open(os.path.join(self.destination, 'a', 'data.bin')) as fp:
+      self.assertEqual(fp.read(), 'raw')
+
+  def test_export(self):
+    self.export()
+    self.check_outputs()
+
+  def test_export_cached(self):
+    outputs = OutputCache(os.path.join(self.root, 'cache'))
+    self.export(outputs=outputs)
+    self.check_outputs()
+    # Only the outputs of processors are cached
+    self.assertEqual(len(outputs._outputs), 10)
+    shutil.rmtree(self.destination)
+    os.mkdir(self.destination)
+    self.export(outputs=outputs)
+    self.check_outputs()
+
+  def test_export_cached_threads(self):
+    outputs = OutputCache(os.path.join(self.root, 'cache'))
+    self.export(outputs=outputs, processing=2, uploads=2)
+    shutil.rmtree(self.destination)
+    os.mkdir(self.destination)
+    self.export(outputs=outputs, processing=2, uploads=2)
+    self.check_outputs()
+    # The outputs taken from the cache are temporary links that are removed
+    for dirpath, directories, files in os.walk(os.path.join(self.root, 'cache', 'outputs')):
+      self.assertEqual([name for name in files if name.startswith('.')], [])
+
+  def test_checkout_evicted(self):
+    outputs = OutputCache(os.path.join(self.root, 'cache'), 4)
+    source = os.path.join(self.source, 'a', 'data.raw')
+    outputs.put('a' * 40, source)
+    output = outputs.checkout('a' * 40)
+    outputs.put('b' * 40, source)
+    self.assertEqual(outputs.get('a' * 40), None)
+    with open(output) as fp:
+      self.assertEqual(fp.read(), 'raw')
+    os.unlink(output)
+
+  def test_failures(self):
+    rules = [{'includes' : '**/f1.txt', 'process' : {'processor' : 'regex', 'pattern' : 'secret', 'replacement' : '\\1'}}] + RULES
+    self.assertEqual(self.export(rules, processing=2), 1)
+    self.assertFalse(os.path.exists(os.path.join(self.destination, 'a', 'b', 'f1.txt')))
+
+  def test_workers_failure(self):
+    temp = os.path.join(self.root, 'temp')
+    os.mkdir(temp)
+    rules = [{'includes' : '**/f5.txt', 'process' : {'processor' : 'regex', 'pattern' : 'secret', 'replacement' : '\\1'}}] + RULES
+    tempdir, tempfile.tempdir = tempfile.tempdir, temp
+    try:
+      workers = folderexport.ProcessorPool(2, {'rules' : rules}, 2)
+      try:
+        self.assertRaises(Exception, self.export, rules, workers=workers)
+      finally:
+        workers.close()
+    finally:
+      tempfile.tempdir = tempdir
+    # The outputs of the files after the failed one are removed
+    self.assertEqual(os.listdir(temp), [])
+
+  def test_renamed_folder(self):
+    rules = [{'includes' : 'a/b', 'rename' : 'renamed'}] + RULES
+    for storage in (LocalStorage(), PlainStorage()):
+      shutil.rmtree(self.destination)
+      os.mkdir(self.destination)
+      self.export(rules, storage)
+      self.assertTrue(os.path.isdir(os.path.join(self.destination, 'a', 'renamed')))
+      self.check_outputs()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from foldersync.ignore import IgnoreRules, IgnoreTree, IGNORE_FILE, MAX_GROUPS
+
+class IgnoreRulesTest(unittest.TestCase):
+
+  def test_name(self):
+    rules = IgnoreRules(['*.log'])
+    self.assertEqual(rules.match('x.log'), True)
+    self.assertEqual(rules.match('a/b/x.log'), True)
+    self.assertEqual(rules.match('a/x.txt'), None)
+    self.assertEqual(rules.match('a.log/x'), None)
+
+  def test_anchored(self):
+    rules = IgnoreRules(['/build', 'doc/*.txt'])
+    self.assertEqual(rules.match('build'), True)
+    self.assertEqual(rules.match('a/build'), None)
+    self.assertEqual(rules.match('doc/a.txt'), True)
+    self.assertEqual(rules.match('x/doc/a.txt'), None)
+    self.assertEqual(rules.match('doc/x/a.txt'), None)
+
+  def test_directory_only(self):
+    rules = IgnoreRules(['tmp/'])
+    self.assertEqual(rules.match('tmp', True), True)
+    self.assertEqual(rules.match('a/tmp', True), True)
+    self.assertEqual(rules.match('tmp'), None)
+
+  def test_negation(self):
+    rules = IgnoreRules(['*.log', '!keep.log'])
+    self.assertEqual(rules.match('x.log'), True)
+    self.assertEqual(rules.match('a/keep.log'), False)
+    # The last matching rule wins
+    rules = IgnoreRules(['!keep.log', '*.log'])
+    self.assertEqual(rules.match('keep.log'), True)
+
+  def test_double_star(self):
+    rules = IgnoreRules(['**/cache', 'a/**/b', 'out/**'])
+    self.assertEqual(rules.match('cache'), True)
+    self.assertEqual(rules.match('x/y/cache'), True)
+    self.assertEqual(rules.match('a/b'), True)
+    self.assertEqual(rules.match('a/x/y/b'), True)
+    self.assertEqual(rules.match('x/a/b'), None)
+    self.assertEqual(rules.match('out/x/y'), True)
+    self.assertEqual(rules.match('out'), None)
+
+  def test_syntax(self):
+    rules = IgnoreRules(['# comment', '', '\\#hash', '\\!bang', 'space\\ ', 'trailing  ', '[!a]?.c'])
+    self.assertEqual(rules.match('# comment'), None)
+    self.assertEqual(rules.match('#hash'), True)
+    self.assertEqual(rules.match('!bang'), True)
+    self.assertEqual(rules.match('space '), True)
+    self.assertEqual(rules.match('trailing'), True)
+    self.assertEqual(rules.match('bx.c'), True)
+    self.assertEqual(rules.match('ax.c'), None)
+    self.assertEqual(rules.match('b/.c'), None)
+
+  def test_many_rules(self):
+    lines = ['f%d' % i for i in range(2 * MAX_GROUPS + 10)] + ['!f5']
+    rules = IgnoreRules(lines)
+    self.assertEqual(rules.match('f5'), False)
+    self.assertEqual(rules.match('f%d' % (2 * MAX_GROUPS + 9)), True)
+    self.assertEqual(rules.match('f0'), True)
+
+class IgnoreTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.write('', ['*.txt', 'build/', '!build/keep.txt', '!*.md'])
+    self.write('sub', ['!*.txt', 'secret.md'])
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def write(self, directory, lines):
+    if not os.path.isdir(os.path.join(self.root, directory)):
+      os.makedirs(os.path.join(self.root, directory))
+    with open(os.path.join(self.root, directory, IGNORE_FILE), 'w') as fp:
+      fp.write('\n'.join(lines) + '\n')
+
+  def test_tree(self):
+    tree = IgnoreTree(self.root)
+    self.assertTrue(tree.is_ignored('x.txt'))
+    self.assertFalse(tree.is_ignored('x.md'))
+    # Deeper files take precedence
+    self.assertFalse(tree.is_ignored('sub/x.txt'))
+    self.assertFalse(tree.is_ignored('sub/deeper/x.txt'))
+    self.assertTrue(tree.is_ignored('sub/secret.md'))
+    self.assertTrue(tree.is_ignored(IGNORE_FILE))
+
+  def test_ignored_directory(self):
+    tree = IgnoreTree(self.root)
+    self.assertTrue(tree.is_ignored('build', True))
+    self.assertTrue(tree.is_directory_ignored('build/x'))
+    # Nothing inside an ignored directory can be included again
+    self.assertTrue(tree.is_ignored('build/keep.txt'))
+    self.assertTrue(tree.is_ignored('sub/build', True))
+    # A file named like an ignored directory is not ignored
+    self.assertFalse(tree.is_ignored('sub/build'))
+
+  def test_reload(self):
+    tree = IgnoreTree(self.root)
+    self.assertTrue(tree.is_ignored('sub/secret.md'))
+    self.write('sub', [])
+    self.assertTrue(tree.is_ignored('sub/secret.md'))
+    tree.reload('sub')
+    self.assertFalse(tree.is_ignored('sub/secret.md'))
+    self.assertTrue(tree.is_ignored('sub/x.txt'))
+
+if __name__ == '__main__':
+  unittest.main()
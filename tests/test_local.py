@@ -0,0 +1,39 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from foldersync.storage.local import LocalStorage, copy_file
+
+class LocalStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.source = os.path.join(self.root, 'source')
+    self.destination = os.path.join(self.root, 'destination')
+    with open(self.source, 'w') as fp:
+      fp.write('content')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def read(self, filename):
+    with open(filename) as fp:
+      return fp.read()
+
+  def test_copy_over_link(self):
+    LocalStorage(hardlink=True).put(self.source, self.destination)
+    self.assertTrue(os.path.samefile(self.source, self.destination))
+    LocalStorage().put(self.source, self.destination)
+    self.assertEqual(self.read(self.source), 'content')
+    self.assertEqual(self.read(self.destination), 'content')
+    self.assertFalse(os.path.samefile(self.source, self.destination))
+
+  def test_copy_same_file(self):
+    self.assertRaises(IOError, copy_file, self.source, self.source)
+    self.assertEqual(self.read(self.source), 'content')
+
+if __name__ == '__main__':
+  unittest.main()
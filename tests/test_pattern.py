@@ -0,0 +1,70 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import random
+import unittest
+
+from foldersync.pattern import Pattern, PatternSet, PatternError, compile_patterns
+
+ELEMENTS = ['**', '*', '?', 'a', 'b', 'ab', 'a*', '*b', '?b', '[ab]', '[!a]*', '*.txt', 'x.*', '*.*']
+NAMES = ['a', 'b', 'ab', 'ba', 'bb', 'abc', 'x.txt', 'a.txt', 'x.y', 'b.txt.gz', '.txt', 'c']
+
+def random_glob(generator):
+  elements = [generator.choice(ELEMENTS) for _ in range(generator.randint(1, 4))]
+  glob = '/'.join(elements)
+  if generator.random() < 0.3:
+    glob = '/' + glob
+  if generator.random() < 0.1:
+    glob = glob + '/'
+  return glob
+
+def random_path(generator):
+  return [generator.choice(NAMES) for _ in range(generator.randint(1, 5))]
+
+def create_patterns(generator, count):
+  patterns = []
+  while len(patterns) < count:
+    try:
+      patterns.append(Pattern.create(random_glob(generator)))
+    except PatternError:
+      pass
+  return patterns
+
+class PatternTest(unittest.TestCase):
+  """Compares the compiled regular expressions with the interpreter of the
+  patterns on generated globs and paths."""
+
+  def setUp(self):
+    self.generator = random.Random(1234)
+
+  def test_match_path(self):
+    for _ in range(300):
+      pattern = create_patterns(self.generator, 1)[0]
+      for _ in range(30):
+        elements = random_path(self.generator)
+        self.assertEqual(pattern.match_file(elements), pattern.match_path('/'.join(elements)),
+          '%s on %s' % (pattern, '/'.join(elements)))
+
+  def test_pattern_set(self):
+    for _ in range(100):
+      patterns = PatternSet()
+      for pattern in create_patterns(self.generator, self.generator.randint(1, 3)):
+        patterns.extend(pattern)
+      for _ in range(30):
+        elements = random_path(self.generator)
+        self.assertEqual(patterns.match_file(elements), patterns.match_path('/'.join(elements)),
+          '%s on %s' % (patterns, '/'.join(elements)))
+
+  def test_compile_patterns(self):
+    for _ in range(200):
+      includes = create_patterns(self.generator, self.generator.randint(0, 2))
+      excludes = create_patterns(self.generator, self.generator.randint(0, 2))
+      expression = compile_patterns(includes, excludes)
+      for _ in range(30):
+        elements = random_path(self.generator)
+        expected = (not includes or any(pattern.match_file(elements) for pattern in includes)) and \
+          not any(pattern.match_file(elements) for pattern in excludes)
+        self.assertEqual(expected, expression.match('/'.join(elements)) is not None,
+          '%s, %s on %s' % ([str(p) for p in includes], [str(p) for p in excludes], '/'.join(elements)))
+
+if __name__ == '__main__':
+  unittest.main()
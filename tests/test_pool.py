@@ -0,0 +1,73 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import socket
+import unittest
+
+from foldersync.storage.pool import ConnectionPool
+from foldersync.transfer import TransferPool
+
+class Connection(object):
+
+  def alive(self):
+    return True
+
+  def check(self):
+    # Every failed operation looks like a broken connection
+    return False
+
+  def close(self):
+    pass
+
+class Storage(object):
+
+  def __init__(self):
+    self.closed = 0
+
+  def close(self):
+    self.closed += 1
+
+class PoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.calls = 0
+
+  def lost(self, connection):
+    self.calls += 1
+    raise IOError('connection lost')
+
+  def test_run_retries(self):
+    pool = ConnectionPool(Connection, retries=2, backoff=0)
+    self.assertRaises(IOError, pool.run, self.lost)
+    self.assertEqual(self.calls, 3)
+
+  def test_run_once(self):
+    pool = ConnectionPool(Connection, retries=2, backoff=0)
+    self.assertRaises(IOError, pool.run_once, self.lost)
+    self.assertEqual(self.calls, 1)
+
+  def connect(self, error):
+    def connect():
+      self.calls += 1
+      raise error
+    return connect
+
+  def test_connect_retries(self):
+    pool = ConnectionPool(self.connect(socket.error('connection refused')), retries=2, backoff=0)
+    self.assertRaises(socket.error, pool.acquire)
+    self.assertEqual(self.calls, 3)
+
+  def test_connect_configuration(self):
+    # E.g. a missing key file, repeating does not help
+    pool = ConnectionPool(self.connect(IOError('no such file')), retries=2, backoff=0)
+    self.assertRaises(IOError, pool.acquire)
+    self.assertEqual(self.calls, 1)
+
+  def test_shared_storage_closed_once(self):
+    storage = Storage()
+    other = Storage()
+    transfers = TransferPool([storage, storage, storage, other])
+    transfers.close()
+    self.assertEqual((storage.closed, other.closed), (1, 1))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from foldersync.storage import Status, partial_name, put_resumable
+
+class ResumableTest(unittest.TestCase):
+  """Runs the resumable upload against steps that work on local files."""
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.source = os.path.join(self.root, 'source')
+    self.destination = os.path.join(self.root, 'destination')
+    self.partial = partial_name(self.destination)
+    with open(self.source, 'wb') as fp:
+      fp.write('0123456789' * 100)
+    self.offsets = []
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def stat(self, path):
+    if not os.path.exists(path):
+      return None
+    return Status(os.path.getmtime(path), os.path.getsize(path))
+
+  def write(self, localpath, path, offset):
+    self.offsets.append(offset)
+    with open(localpath, 'rb') as local, open(path, 'r+b' if offset else 'wb') as remote:
+      local.seek(offset)
+      remote.seek(offset)
+      remote.write(local.read())
+
+  def verify(self, localpath, path, size):
+    with open(localpath, 'rb') as local, open(path, 'rb') as remote:
+      return local.read() == remote.read()
+
+  def upload(self):
+    put_resumable(self.source, self.destination, self.stat, self.write, self.verify, os.rename)
+    with open(self.destination, 'rb') as fp:
+      self.assertEqual(fp.read(), '0123456789' * 100)
+    self.assertFalse(os.path.exists(self.partial))
+
+  def write_partial(self, data, age=0):
+    with open(self.partial, 'wb') as fp:
+      fp.write(data)
+    # Whole seconds, so the times compare exactly
+    modified = int(os.path.getmtime(self.source))
+    os.utime(self.source, (modified, modified))
+    os.utime(self.partial, (modified - age, modified - age))
+
+  def test_new(self):
+    self.upload()
+    self.assertEqual(self.offsets, [0])
+
+  def test_resume(self):
+    self.write_partial('0123456789' * 30)
+    self.upload()
+    self.assertEqual(self.offsets, [300])
+
+  def test_stale(self):
+    self.write_partial('0123456789' * 30, 60)
+    self.upload()
+    self.assertEqual(self.offsets, [0])
+
+  def test_mismatch(self):
+    # The part is newer than the file but does not belong to it
+    self.write_partial('x' * 300)
+    self.upload()
+    self.assertEqual(self.offsets, [300, 0])
+
+  def test_failed(self):
+    self.verify = lambda localpath, path, size: False
+    self.assertRaises(IOError, put_resumable, self.source, self.destination, self.stat, self.write,
+      self.verify, os.rename)
+    self.assertFalse(os.path.exists(self.destination))
+
+if __name__ == '__main__':
+  unittest.main()
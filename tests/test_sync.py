@@ -0,0 +1,175 @@
+# -*- Mode: python; indent-tabs-mode: nil; c-basic-offset: 2; tab-width: 2 -*-
+
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+import foldersync
+from foldersync import FolderSync
+from foldersync.digest import DigestCache
+from foldersync.manifest import Manifest
+from foldersync.storage.local import LocalStorage
+
+folderwatch = imp.load_source('folderwatch', os.path.join(os.path.dirname(__file__), '..', 'bin', 'folderwatch'))
+
+class NoRenameStorage(LocalStorage):
+
+  def rename(self, remotepath_old, remotepath_new):
+    raise IOError('rename not permitted')
+
+class ArchiveStorage(LocalStorage):
+
+  def __init__(self, vanishing=None):
+    super(ArchiveStorage, self).__init__()
+    self.archives = []
+    self.vanishing = vanishing
+
+  def put_archive(self, remotepath, files):
+    if self.vanishing is not None and os.path.exists(self.vanishing):
+      os.unlink(self.vanishing)
+    self.archives.append(len(files))
+    packed = []
+    for localpath, path in files:
+      if os.path.exists(localpath):
+        self.put(localpath, os.path.join(remotepath, path))
+        packed.append((localpath, path))
+    return packed
+
+class FailingStorage(LocalStorage):
+
+  def __init__(self, failing):
+    super(FailingStorage, self).__init__()
+    self.failing = failing
+
+  def put(self, localpath, remotepath):
+    if os.path.basename(localpath) == self.failing:
+      raise IOError('upload failed')
+    super(FailingStorage, self).put(localpath, remotepath)
+
+class Event(object):
+
+  def __init__(self, src_path, is_directory=False):
+    self.src_path = src_path
+    self.is_directory = is_directory
+
+class SyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.source = os.path.join(self.root, 'source')
+    self.destination = os.path.join(self.root, 'destination')
+    os.makedirs(os.path.join(self.source, 'a'))
+    os.mkdir(self.destination)
+    with open(os.path.join(self.source, 'a', 'f.txt'), 'w') as fp:
+      fp.write('content')
+
+  def tearDown(self):
+    shutil.rmtree(self.root, True)
+
+  def test_move_fallback_with_digests(self):
+    folder = FolderSync(NoRenameStorage(), self.source, self.destination, digests=DigestCache())
+    folder.scan()
+    source = os.path.join(self.source, 'a', 'f.txt')
+    destination = os.path.join(self.source, 'a', 'g.txt')
+    os.rename(source, destination)
+    self.assertTrue(folder.move(source, destination))
+    folder.close()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'a', 'g.txt')))
+
+  def test_rescan_new_file(self):
+    folder = FolderSync(LocalStorage(), self.source, self.destination)
+    folder.scan()
+    os.mkdir(os.path.join(self.source, 'a', 'c'))
+    with open(os.path.join(self.source, 'a', 'c', 'new.txt'), 'w') as fp:
+      fp.write('new')
+    folder.rescan(os.path.join(self.source, 'a'))
+    folder.close()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'a', 'c', 'new.txt')))
+
+  def test_watch_new_file(self):
+    folder = folderwatch.FolderWatcher(LocalStorage(), self.source, self.destination, quiet=0)
+    folder.scan()
+    filename = os.path.join(self.source, 'a', 'new.txt')
+    with open(filename, 'w') as fp:
+      fp.write('new')
+    folder._events.add(filename, 0)
+    folder.dispatch()
+    folder.close()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'a', 'new.txt')))
+
+  def test_watch_new_directory(self):
+    folder = folderwatch.FolderWatcher(LocalStorage(), self.source, self.destination, quiet=0)
+    folder.scan()
+    directory = os.path.join(self.source, 'new')
+    os.mkdir(directory)
+    folder.on_created(Event(directory, True))
+    with open(os.path.join(directory, '1.txt'), 'w') as fp:
+      fp.write('new')
+    folder.on_created(Event(os.path.join(directory, '1.txt')))
+    folder.dispatch()
+    folder.close()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'new', '1.txt')))
+
+  def test_watch_ignore_changed(self):
+    ignore = os.path.join(self.source, 'a', folderwatch.IGNORE_FILE)
+    with open(ignore, 'w') as fp:
+      fp.write('*.log\n')
+    with open(os.path.join(self.source, 'a', 'x.log'), 'w') as fp:
+      fp.write('log')
+    folder = folderwatch.FolderWatcher(LocalStorage(), self.source, self.destination, quiet=0)
+    folder.scan()
+    self.assertFalse(os.path.exists(os.path.join(self.destination, 'a', 'x.log')))
+    with open(ignore, 'w') as fp:
+      fp.write('')
+    folder.on_modified(Event(ignore))
+    folder.dispatch()
+    folder.dispatch()
+    folder.close()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'a', 'x.log')))
+
+  def test_watch_failed_upload(self):
+    storage = FailingStorage(None)
+    folder = folderwatch.FolderWatcher(storage, self.source, self.destination, quiet=0)
+    folder.scan()
+    storage.failing = 'f.txt'
+    for name in ('f.txt', 'g.txt'):
+      filename = os.path.join(self.source, 'a', name)
+      with open(filename, 'w') as fp:
+        fp.write('changed')
+      folder._events.add(filename, 0)
+    folder.dispatch()
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'a', 'g.txt')))
+    # The failed file is uploaded with its next event
+    storage.failing = None
+    folder._events.add(os.path.join(self.source, 'a', 'f.txt'), 0)
+    folder.dispatch()
+    folder.close()
+    with open(os.path.join(self.destination, 'a', 'f.txt')) as fp:
+      self.assertEqual(fp.read(), 'changed')
+
+  def test_bulk_chunks(self):
+    os.mkdir(os.path.join(self.source, 'b'))
+    for i in range(24):
+      with open(os.path.join(self.source, 'b', 'f%d.txt' % i), 'w') as fp:
+        fp.write('file %d' % i)
+    vanishing = os.path.join(self.source, 'b', 'f0.txt')
+    storage = ArchiveStorage(vanishing)
+    manifest = Manifest(os.path.join(self.root, 'manifest'))
+    chunk = foldersync.BULK_CHUNK
+    foldersync.BULK_CHUNK = 10
+    try:
+      folder = FolderSync(storage, self.source, self.destination, manifest=manifest, bulk_threshold=5)
+      folder.scan()
+      folder.close()
+    finally:
+      foldersync.BULK_CHUNK = chunk
+    self.assertEqual(storage.archives, [10, 10, 5])
+    self.assertTrue(os.path.exists(os.path.join(self.destination, 'b', 'f23.txt')))
+    self.assertFalse('b/f0.txt' in manifest)
+    self.assertTrue('b/f1.txt' in manifest)
+    self.assertTrue('b' in manifest)
+
+if __name__ == '__main__':
+  unittest.main()